@@ -0,0 +1,61 @@
+import queue
+import threading
+from collections import deque
+
+
+class PipelineError(Exception):
+    """A stage or the writer failed, so nothing the crawl fetches from now on can be stored."""
+
+
+class BacklogQueue:
+    """
+    Bounded queue whose `put` never blocks, for producers running on the event loop.
+    Items that don't fit wait in an ordered backlog and move into the queue as the
+    consumer takes items, so they are got in the order they were put. `full` is true
+    while anything waits, callers await it draining, e.g. in `wait_ready`.
+    e.g.
+        pending = BacklogQueue(8)
+        pending.put(batch)  # from the loop
+        batch = pending.get()  # from the consumer thread
+    """
+
+    def __init__(self, maxsize):
+        self.queue = queue.Queue(maxsize)
+        self.backlog = deque()
+        self.lock = threading.Lock()
+
+    def put(self, item):
+        with self.lock:
+            if not self.backlog:
+                try:
+                    self.queue.put_nowait(item)
+                    return
+                except queue.Full:
+                    pass
+            self.backlog.append(item)
+
+    def get(self):
+        item = self.queue.get()
+        self._refill()
+        return item
+
+    def get_nowait(self):
+        item = self.queue.get_nowait()
+        self._refill()
+        return item
+
+    def _refill(self):
+        # the consumer drains the backlog as it takes items, so it never depends on the loop
+        with self.lock:
+            while self.backlog:
+                try:
+                    self.queue.put_nowait(self.backlog[0])
+                except queue.Full:
+                    return
+                self.backlog.popleft()
+
+    def full(self):
+        return bool(self.backlog) or self.queue.full()
+
+    def qsize(self):
+        return self.queue.qsize() + len(self.backlog)
@@ -0,0 +1,132 @@
+"""
+Compares the cleaning time of DataCleaningPipeline with the row-wise implementation it
+replaced, on synthetic listings shaped like scraped ones, and checks both agree.
+e.g. python benchmarks/bench_cleaning.py 200000
+"""
+import os
+import random
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pipelines import DataCleaningPipeline
+
+
+
+class LegacyCleaningPipeline:
+    """DataCleaningPipeline before vectorization, kept as the baseline."""
+    df = pd.DataFrame()
+
+    def dropna_cols(self, df):
+        df = df.dropna(thresh=int(df.shape[0] * 0.2), axis=1)
+        return df
+
+    def clean_currency(self, x):
+        """ If the value is a string, then remove currency symbol and delimiters
+        otherwise, the value is numeric and can be converted
+        """
+        # df_merged['Price'] = df_merged['Price'].replace({'\$': '', '֏': '', '₽': '', '€': '', ',': ''}, regex=True)
+        if isinstance(x, str):
+            return x.replace('$', '').replace('֏', '').replace('₽', '').replace('€', '').replace(',', '')
+
+    def split_price_col(self, df):
+        df[['price', 'duration']] = df.price.str.split(expand=True)
+        df['price'] = df.loc[:, 'price'].fillna(0).astype(int)
+        cols = df.columns.to_list()
+        idx_currency = cols.index('currency')
+        idx_duration = cols.index('duration')
+        cols.insert(idx_currency + 1, 'duration')
+        cols.pop()
+        df = df[cols]
+        return df
+
+    def clean(self, df: pd.DataFrame):
+        df_cols = df.columns
+        df['date_posted'] = pd.to_datetime(df['date_posted'], dayfirst=True, format='%b-%d-%Y')
+        for col in ['floor_area', 'land_area', 'room_area']:
+            if col in df_cols:
+                df[col] = df[col].str.extract('(\d+)').fillna(0).astype(int)
+                # df[col] = df[col].astype('str').str.extractall('(\d+)').unstack().fillna('').sum(axis=1).astype(int)
+        for col in ['floors_in_the_building', 'number_of_rooms', 'number_of_bathrooms', 'floor']:
+            if col in df_cols:
+                df[col] = df[col].replace({'\+': ''}, regex=True).fillna(0).astype(int)
+        for col in ['children_are_welcome', 'pets_allowed']:
+            if col in df_cols:
+                df[col] = df[col].replace({'No': 10, 'Yes': 11, 'Negotiable': 12}, regex=True).fillna(0).astype(int)
+        if 'ceiling_height' in df_cols:
+            df['ceiling_height'] = df['ceiling_height'].fillna(0)
+            df['ceiling_height'] = df['ceiling_height'].str.extract('(\d+(?:\.\d+)?)').astype(float)
+            # df['ceiling_height'] = df['ceiling_height'].astype('str').str.extractall('(\d+(?:\.\d+)?)').unstack().fillna('').sum(axis=1).astype(float)
+        if 'utility_payments' in df_cols:
+            df['utility_payments'] = df['utility_payments'].replace(
+                {'Not included': 10, 'Included': 11, 'By Agreement': 12}, regex=True).fillna(0).astype(int)
+        if 'new_construction' in df_cols:
+            df['new_construction'] = pd.Series(np.where(df['new_construction'].values == 'Yes', 1, 0), df.index,
+                                               dtype=int)
+        if 'elevator' in df_cols:
+            df['elevator'] = pd.Series(np.where(df['elevator'].values == 'Available', 1, 0), df.index, dtype=int)
+        return df
+
+    def clean_df(self):
+        self.df = self.dropna_cols(self.df)
+        self.df["price"] = self.df['price'].apply(self.clean_currency)
+        if self.df['price'].str.contains('daily').any() or self.df['price'].str.contains('monthly').any():
+            self.df = self.split_price_col(self.df)
+        self.df = self.clean(self.df)
+        return self.df
+
+
+def make_listings(n, seed=0):
+    rnd = random.Random(seed)
+    rows = []
+    for i in range(n):
+        rows.append({
+            'id': '%064x' % i,
+            # asking prices are mostly round numbers
+            'price': rnd.choice(['$%s' % format(rnd.randrange(20, 900) * 500, ','),
+                                 '%s ֏ monthly' % format(rnd.randrange(50, 900) * 1000, ','),
+                                 '€%d daily' % rnd.randrange(10, 300)]),
+            'currency': rnd.choice(['USD', 'AMD', 'EUR']),
+            'date_posted': rnd.choice(['Jan-05-2023', 'Feb-17-2023', 'Dec-31-2022']),
+            'floor_area': '%d sq.m.' % rnd.randrange(20, 400),
+            'land_area': rnd.choice([None, '%d sq.m.' % rnd.randrange(100, 5000)]),
+            'number_of_rooms': rnd.choice(['1', '2', '3', '4', '5', '6+']),
+            'number_of_bathrooms': rnd.choice(['1', '2', '3+']),
+            'floor': str(rnd.randrange(1, 20)),
+            'floors_in_the_building': str(rnd.randrange(1, 25)),
+            'ceiling_height': rnd.choice([None, '2.8 m', '3 m', '3.2 m']),
+            'children_are_welcome': rnd.choice(['No', 'Yes', 'Negotiable', None]),
+            'pets_allowed': rnd.choice(['No', 'Yes', 'Negotiable']),
+            'utility_payments': rnd.choice(['Not included', 'Included', 'By Agreement']),
+            'new_construction': rnd.choice(['Yes', 'No']),
+            'elevator': rnd.choice(['Available', 'Not available']),
+            'address': 'Kentron, Yerevan',
+        })
+    return pd.DataFrame.from_records(rows)
+
+
+def timed(pipeline, df):
+    pipeline.df = df.copy()
+    started = time.perf_counter()
+    result = pipeline.clean_df()
+    return time.perf_counter() - started, result
+
+
+def main(n=100000):
+    df = make_listings(n)
+    legacy_time, expected = timed(LegacyCleaningPipeline(), df)
+    vectorized_time, result = timed(DataCleaningPipeline(), df)
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+    scale = 1_000_000 / n
+    print(f"{n} rows, results match")
+    print(f"legacy:     {legacy_time * scale:8.2f}s per million rows, {expected.memory_usage(deep=True).sum() / n:6.0f} bytes per row")
+    print(f"vectorized: {vectorized_time * scale:8.2f}s per million rows, {result.memory_usage(deep=True).sum() / n:6.0f} bytes per row")
+    print(f"speedup:    {legacy_time / vectorized_time:8.1f}x")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
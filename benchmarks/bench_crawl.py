@@ -0,0 +1,204 @@
+"""
+Offline end-to-end crawl benchmark. Starts the fake list.am of `fake_listam.py` and a
+throwaway Postgres database, runs `main.extract_urls` and `main.extract_items` against
+them and reports pages/s, items/s, latency percentiles, peak RSS and database load time
+per phase. Results are saved as JSON, pass an earlier one as `--baseline` to compare.
+The database is created on the server of `--dsn` (POSTGRES_URL by default) and dropped
+afterwards, or run by `pgserver` in a temporary directory if neither is given.
+e.g. python benchmarks/bench_crawl.py --pages 10 --latency 0.05 --error-rate 0.01
+     python benchmarks/bench_crawl.py --baseline benchmarks/results/crawl-20240101-120000.json
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import psycopg2
+import psycopg2.extensions
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_listam import CATEGORIES, REGIONS, FakeListAm
+
+# compared with `--baseline`, and whether higher is better
+KEY_METRICS = {'seconds': False, 'pages_per_s': True, 'items_per_s': True, 'ttfb_p99': False,
+               'db_load_seconds': False, 'peak_rss_mb': False}
+
+
+@contextlib.contextmanager
+def database(dsn=None):
+    """Yields the dsn of an empty database that is removed afterwards."""
+    dsn = dsn or os.environ.get('POSTGRES_URL')
+    if not dsn:
+        try:
+            import pgserver
+        except ImportError:
+            sys.exit("No Postgres to run the benchmark on: pass --dsn or set POSTGRES_URL, "
+                     "or install the dev packages with `pipenv install --dev` to get pgserver")
+        with tempfile.TemporaryDirectory() as pgdata:
+            server = pgserver.get_server(pgdata, cleanup_mode='delete')
+            try:
+                yield server.get_uri()
+            finally:
+                server.cleanup()
+        return
+    name = f'bench_crawl_{os.getpid()}'
+    admin = psycopg2.connect(dsn)
+    admin.autocommit = True
+    try:
+        admin.cursor().execute(f'CREATE DATABASE {name}')
+        yield psycopg2.extensions.make_dsn(dsn, dbname=name)
+    finally:
+        admin.cursor().execute(f'DROP DATABASE IF EXISTS {name} WITH (FORCE)')
+        admin.close()
+
+
+def seed_database(dsn):
+    """Creates categories and regions of the fake site, as `DB.create_table_categories` would."""
+    with psycopg2.connect(dsn) as conn, conn.cursor() as cur:
+        cur.execute('CREATE TABLE property_type (id SERIAL PRIMARY KEY, name VARCHAR(255), q_string VARCHAR(16) UNIQUE)')
+        cur.execute('CREATE TABLE regions (id SERIAL PRIMARY KEY, name VARCHAR(255), q_string VARCHAR(16) UNIQUE)')
+        cur.executemany('INSERT INTO property_type (name, q_string) VALUES (%s, %s)',
+                        [(name, f'/category/{cat}') for name, cat, _, _ in CATEGORIES])
+        cur.executemany('INSERT INTO regions (name, q_string) VALUES (%s, %s)',
+                        [(name, f'?n={reg}') for name, reg in REGIONS])
+    conn.close()
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def phase_result(metrics, seconds):
+    summary = metrics.REGISTRY.summary()
+    pages = int(summary['crawler_responses_total'].get('200', 0))
+    items = sum(summary['crawler_items_total'].values())
+    stages = summary['crawler_stage_seconds']
+    latency = {phase: {'p50': h['p50'], 'p99': h['p99'], 'count': h['count']}
+               for phase, h in list(summary['crawler_request_seconds'].items()) + list(stages.items()) if h['count']}
+    ttfb = latency.get('ttfb', {})
+    return {
+        'seconds': seconds,
+        'pages': pages,
+        'pages_per_s': pages / seconds,
+        'items': items,
+        'items_per_s': items / seconds,
+        'ttfb_p50': ttfb.get('p50'),
+        'ttfb_p99': ttfb.get('p99'),
+        'latency': latency,
+        'db_load_seconds': sum(stages[stage]['sum'] for stage in ('load', 'load_urls') if stage in stages),
+        'retries': summary['crawler_retries_total'],
+        'errors': summary['crawler_errors_total'],
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def run(args):
+    with FakeListAm(pages=args.pages, items_per_page=args.items_per_page, latency=args.latency,
+                    jitter=args.jitter, error_rate=args.error_rate, seed=args.seed) as site, \
+            database(args.dsn) as dsn:
+        seed_database(dsn)
+        os.environ['POSTGRES_URL'] = dsn
+        import main
+        import metrics
+        import utils.utils
+        from db import close_pools
+        from runtime import CrawlerRuntime
+        utils.utils.BASE_URL = site.base_url + '/en'
+
+        phases = {}
+        try:
+            with CrawlerRuntime() as runtime:
+                metrics.REGISTRY.reset()
+                started = time.perf_counter()
+                links = main.extract_urls(runtime=runtime)
+                phases['urls'] = dict(phase_result(metrics, time.perf_counter() - started), links=links)
+
+                metrics.REGISTRY.reset()
+                started = time.perf_counter()
+                main.extract_items(chunk_size=args.chunk_size, parse_workers=args.parse_workers, runtime=runtime)
+                phases['items'] = phase_result(metrics, time.perf_counter() - started)
+        finally:
+            close_pools()
+        with urllib.request.urlopen(site.base_url + '/stats') as response:
+            served = json.load(response)
+    return phases, served
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(result, baseline):
+    print(f"\nAgainst {baseline['revision']} of {baseline['date']}:")
+    changed = {key for key, value in result['options'].items()
+               if key not in ('out', 'baseline') and baseline['options'].get(key) != value}
+    if changed:
+        print(f"Options differ ({', '.join(sorted(changed))}), results are not comparable one to one.")
+    for phase, values in result['phases'].items():
+        before = baseline['phases'].get(phase, {})
+        for key, higher_is_better in KEY_METRICS.items():
+            if values.get(key) is None or not before.get(key):
+                continue
+            change = values[key] / before[key] - 1
+            worse = change < 0 if higher_is_better else change > 0
+            flag = '  <- regression' if worse and abs(change) > 0.1 else ''
+            print(f'{phase:>6} {key:<16} {before[key]:>10.3f} -> {values[key]:>10.3f} {change:+7.1%}{flag}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=int, default=5, help='listing pages per category and region')
+    parser.add_argument('--items-per-page', type=int, default=40)
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.01)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of 503 responses')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--parse-workers', type=int, default=None)
+    parser.add_argument('--dsn', default=None, help='Postgres server to create the throwaway database on')
+    parser.add_argument('--out', default=None, help='result file, benchmarks/results/crawl-<time>.json by default')
+    parser.add_argument('--baseline', default=None, help='earlier result file to compare with')
+    args = parser.parse_args()
+
+    phases, served = run(args)
+    result = {
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'options': vars(args),
+        'served': served,
+        'phases': phases,
+    }
+    out = args.out or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results',
+                                   time.strftime('crawl-%Y%m%d-%H%M%S.json'))
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump(result, f, indent=2)
+
+    for phase, values in phases.items():
+        print(f"{phase:>6}: {values['pages']} pages in {values['seconds']:.2f}s, "
+              f"{values['pages_per_s']:.1f} pages/s, {values['items_per_s']:.1f} items/s, "
+              f"ttfb p50/p99 {values['ttfb_p50'] or 0:.3f}/{values['ttfb_p99'] or 0:.3f}s, "
+              f"db load {values['db_load_seconds']:.2f}s, peak RSS {values['peak_rss_mb']:.0f} MB")
+    print(f'Saved to {out}')
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(result, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
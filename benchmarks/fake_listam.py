@@ -0,0 +1,179 @@
+"""
+Local stand-in for list.am serving synthetic category and item pages, so crawls can be
+benchmarked offline. Listing pages link items as `/en/item/<id>` and paginate with
+`Next >` links, item pages have the markup `parsers.parse_item` reads.
+Responses are delayed by `latency` +- `jitter` seconds and fail with 503 at `error_rate`.
+e.g. python benchmarks/fake_listam.py --port 8080 --pages 10 --latency 0.05
+"""
+import argparse
+import asyncio
+import multiprocessing
+import random
+
+from aiohttp import web
+
+# table name, category path id, property type and purchase as in the breadcrumbs
+CATEGORIES = (
+    ('apartments_for_sale', 60, 'Apartments', 'For Sale'),
+    ('houses_for_sale', 62, 'Houses', 'For Sale'),
+    ('apartments_for_rent', 56, 'Apartments', 'For Rent'),
+    ('houses_for_rent', 63, 'Houses', 'For Rent'),
+)
+REGIONS = (('Yerevan', 1), ('Armavir', 23), ('Kotayk', 10))
+CONSTRUCTION = ('Stone', 'Panels', 'Monolith', 'Bricks')
+CURRENCIES = (('USD', '$'), ('AMD', '֏'), ('EUR', '€'))
+
+LISTING_PAGE = '<html><head><title>{title}</title></head><body><div class="dl">{cards}</div>{next}</body></html>'
+CARD = ('<a href="/en/item/{id}" class="h"><img src="//s.list.am/r/{id}.webp"><div class="p">{symbol}{price:,}'
+        '</div><div class="l">{region}, {rooms} rooms, {area} sq.m.</div></a>')
+NEXT = '<a class="b" href="/en/category/{cat}/{page}?n={reg}&amp;crc=1">Next ></a>'
+ITEM_PAGE = """<html><head><meta itemprop="priceCurrency" content="{currency}"></head><body>
+<div id="crumb"><ol><li><a href="/"><span>Home</span></a></li><li><span>Real Estate</span></li>\
+<li><span>{group}</span></li><li><a href="/en/category/{cat}"><span>{group}</span></a></li>\
+<div class="c"><span>{purchase}</span></div></ol></div>
+<div class="p"><span class="price" itemprop="price">{symbol}{price:,}</span></div>
+<div class="loc">{region}, Street {street}</div>
+<div class="attr"><div class="c"><div class="t">Construction Type</div><div class="i">{construction}</div></div>
+<div class="c"><div class="t">Floor Area</div><div class="i">{area} sq.m.</div></div>
+<div class="c"><div class="t">Number of Rooms</div><div class="i">{rooms}</div></div>
+<div class="c"><div class="t">Floor</div><div class="i">{floor}</div></div>
+<div class="c"><div class="t">Description</div><div class="i">{description}</div></div></div>
+<div id="uinfo"><a href="/user/{user}">Agent</a></div>
+<div class="footer"><span>Item ID {id}</span><span itemprop="datePosted">Posted {posted}</span>\
+<span>Renewed {renewed}</span></div>
+</body></html>"""
+
+
+def item_id(cat, reg, page, i):
+    return ((cat * 100 + reg) * 1000 + page) * 1000 + i
+
+
+def item(id):
+    """Attributes of an item, the same on every request."""
+    rnd = random.Random(id)
+    currency, symbol = rnd.choice(CURRENCIES)
+    day, month = rnd.randint(1, 28), rnd.randint(1, 12)
+    return {
+        'id': id,
+        'currency': currency,
+        'symbol': symbol,
+        'price': rnd.randrange(20, 500) * 1000,
+        'rooms': rnd.randint(1, 6),
+        'area': rnd.randint(25, 300),
+        'floor': rnd.randint(1, 16),
+        'construction': rnd.choice(CONSTRUCTION),
+        'street': rnd.randint(1, 200),
+        'user': rnd.randrange(10 ** 6),
+        'posted': '%02d.%02d.2023' % (day, month),
+        'renewed': '%02d.%02d.2024' % (day, month),
+        'description': 'Sunny flat ' * rnd.randint(5, 60),
+    }
+
+
+def make_app(pages=5, items_per_page=40, latency=0.02, jitter=0.01, error_rate=0.0, seed=0):
+    categories = {cat: (name, group, purchase) for name, cat, group, purchase in CATEGORIES}
+    regions = dict((reg, name) for name, reg in REGIONS)
+    rnd = random.Random(seed)
+    stats = {'listing_pages': 0, 'item_pages': 0, 'errors': 0}
+
+    async def delay():
+        await asyncio.sleep(max(0.0, rnd.uniform(latency - jitter, latency + jitter)))
+        if rnd.random() < error_rate:
+            stats['errors'] += 1
+            raise web.HTTPServiceUnavailable()
+
+    async def listing(request):
+        await delay()
+        cat, page = int(request.match_info['cat']), int(request.match_info['page'])
+        reg = int(request.query.get('n', 1))
+        if cat not in categories:
+            raise web.HTTPNotFound()
+        stats['listing_pages'] += 1
+        cards, next = '', ''
+        if page <= pages:
+            cards = ''.join(CARD.format(region=regions.get(reg, ''), **item(item_id(cat, reg, page, i)))
+                            for i in range(items_per_page))
+            if page < pages:
+                next = NEXT.format(cat=cat, page=page + 1, reg=reg)
+        return web.Response(text=LISTING_PAGE.format(title=categories[cat][0], cards=cards, next=next),
+                            content_type='text/html')
+
+    async def item_page(request):
+        await delay()
+        id = int(request.match_info['id'])
+        cat, reg = id // 10 ** 8, id // 10 ** 6 % 100
+        if cat not in categories:
+            raise web.HTTPNotFound()
+        stats['item_pages'] += 1
+        _, group, purchase = categories[cat]
+        return web.Response(text=ITEM_PAGE.format(cat=cat, group=group, purchase=purchase,
+                                                  region=regions.get(reg, ''), **item(id)),
+                            content_type='text/html')
+
+    async def stats_page(request):
+        return web.json_response(stats)
+
+    app = web.Application()
+    app.router.add_get('/en/category/{cat}/{page}', listing)
+    app.router.add_get('/en/item/{id}', item_page)
+    app.router.add_get('/stats', stats_page)
+    return app
+
+
+def serve(port=0, ready=None, **options):
+    """Serves the fake site until the process is stopped, putting the bound port on `ready`."""
+    async def start():
+        runner = web.AppRunner(make_app(**options), access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', port)
+        await site.start()
+        return runner.addresses[0][1]
+
+    loop = asyncio.new_event_loop()
+    bound = loop.run_until_complete(start())
+    if ready is not None:
+        ready.put(bound)
+    loop.run_forever()
+
+
+class FakeListAm:
+    """
+    Runs the fake site in a child process, so serving doesn't compete with the crawl
+    for the benchmark's CPU.
+    e.g.
+        with FakeListAm(pages=10, latency=0.05) as site:
+            site.base_url  # 'http://127.0.0.1:41234'
+    """
+
+    def __init__(self, port=0, **options):
+        self.port = port
+        self.options = options
+        self.process = None
+        self.base_url = None
+
+    def __enter__(self):
+        ready = multiprocessing.Queue()
+        self.process = multiprocessing.Process(target=serve, args=(self.port, ready), kwargs=self.options,
+                                               daemon=True)
+        self.process.start()
+        self.port = ready.get(timeout=30)
+        self.base_url = f'http://127.0.0.1:{self.port}'
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.process.terminate()
+        self.process.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--pages', type=int, default=5)
+    parser.add_argument('--items-per-page', type=int, default=40)
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--jitter', type=float, default=0.01)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+    print(f'Serving on http://127.0.0.1:{args.port}/en/category/60/1?n=1')
+    serve(args.port, pages=args.pages, items_per_page=args.items_per_page, latency=args.latency,
+          jitter=args.jitter, error_rate=args.error_rate)
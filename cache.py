@@ -0,0 +1,169 @@
+import os
+import sqlite3
+import time
+import zlib
+
+from utils.log import get_logger
+
+DAY = 60 * 60 * 24
+
+# how long a cached response is used without asking the server, per url class.
+# Item pages are always revalidated: they are requested again when their listing card
+# changed, so a cache hit without asking would hand back the outdated page.
+DEFAULT_TTLS = {
+    'listing': 60 * 60,
+    'item': 0,
+}
+
+
+def url_class(url):
+    return 'item' if '/item/' in url else 'listing'
+
+
+class CachedResponse:
+    """
+    Response read from the cache. Provides the part of `aiohttp.ClientResponse`
+    used by spider callbacks, so they work the same on cache hits.
+    """
+
+    def __init__(self, url, status, body, etag=None, last_modified=None, content_type=None, fetched_at=0.0,
+                 fresh=False):
+        self.url = url
+        self.status = status
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.content_type = content_type
+        self.fetched_at = fetched_at
+        self.fresh = fresh
+
+    @property
+    def headers(self):
+        headers = {}
+        if self.etag:
+            headers['ETag'] = self.etag
+        if self.last_modified:
+            headers['Last-Modified'] = self.last_modified
+        if self.content_type:
+            headers['Content-Type'] = self.content_type
+        return headers
+
+    def validators(self):
+        """Headers making a conditional request for this response."""
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+    async def read(self):
+        return self.body
+
+    async def text(self, encoding=None):
+        if encoding is None:
+            encoding = 'utf-8'
+            if self.content_type and 'charset=' in self.content_type:
+                encoding = self.content_type.split('charset=')[-1].split(';')[0].strip()
+        return self.body.decode(encoding)
+
+
+class ResponseCache:
+    """
+    Persistent HTTP response cache keyed by url, stored in a SQLite file.
+    Bodies are zlib compressed, entries expire per url class (see `DEFAULT_TTLS`)
+    and the least recently used ones are evicted once the bodies exceed `max_bytes`.
+    """
+    name = "ResponseCache"
+    logger = get_logger(name)
+
+    def __init__(self, path='.cache/responses.sqlite', ttls=None, max_bytes=2 * 1024 ** 3, compress_level=6):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.max_bytes = max_bytes
+        self.compress_level = compress_level
+        self.conn = sqlite3.connect(path, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses
+              (url TEXT PRIMARY KEY,
+              status INTEGER,
+              etag TEXT,
+              last_modified TEXT,
+              content_type TEXT,
+              body BLOB,
+              size INTEGER,
+              fetched_at REAL,
+              accessed_at REAL);
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses(accessed_at)")
+        self.size = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        self.hits = self.revalidated = self.misses = 0
+
+    def __enter__(self):
+        return self
+
+    def get(self, url):
+        """Returns the cached response for `url`, with `fresh` set if it is within its TTL."""
+        row = self.conn.execute(
+            "SELECT status, etag, last_modified, content_type, body, fetched_at FROM responses WHERE url = ?",
+            (url,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return
+        status, etag, last_modified, content_type, body, fetched_at = row
+        now = time.time()
+        self.conn.execute("UPDATE responses SET accessed_at = ? WHERE url = ?", (now, url))
+        fresh = now - fetched_at < self.ttls[url_class(url)]
+        if fresh:
+            self.hits += 1
+        return CachedResponse(url, status, zlib.decompress(body), etag, last_modified, content_type,
+                              fetched_at, fresh)
+
+    def store(self, url, status, headers, body):
+        compressed = zlib.compress(body, self.compress_level)
+        now = time.time()
+        old = self.conn.execute("SELECT size FROM responses WHERE url = ?", (url,)).fetchone()
+        self.conn.execute("""
+            INSERT OR REPLACE INTO responses
+            (url, status, etag, last_modified, content_type, body, size, fetched_at, accessed_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (url, status, headers.get('ETag'), headers.get('Last-Modified'), headers.get('Content-Type'),
+              compressed, len(compressed), now, now))
+        self.size += len(compressed) - (old[0] if old else 0)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def touch(self, url, headers=None):
+        """Marks a cached response as revalidated, e.g. after a `304 Not Modified`."""
+        self.revalidated += 1
+        now = time.time()
+        headers = headers or {}
+        self.conn.execute("""
+            UPDATE responses
+            SET fetched_at = ?, accessed_at = ?, etag = COALESCE(?, etag), last_modified = COALESCE(?, last_modified)
+            WHERE url = ?
+        """, (now, now, headers.get('ETag'), headers.get('Last-Modified'), url))
+
+    def evict(self, target=0.9):
+        """Deletes least recently used entries until bodies take at most `target` of `max_bytes`."""
+        limit = self.max_bytes * target
+        rows = self.conn.execute("SELECT url, size FROM responses ORDER BY accessed_at")
+        evicted = []
+        for url, size in rows:
+            if self.size <= limit:
+                break
+            evicted.append((url,))
+            self.size -= size
+        rows.close()
+        self.conn.executemany("DELETE FROM responses WHERE url = ?", evicted)
+        self.logger.info("Evicted %d responses from cache", len(evicted))
+
+    def close(self):
+        self.conn.close()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
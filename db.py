@@ -1,11 +1,16 @@
 import asyncio
+import threading
+import time
+from contextlib import contextmanager
 from typing import Tuple
 
 import psycopg2
+import psycopg2.pool
 from sqlalchemy import create_engine
 from io import StringIO
 from config import config
 from psycopg2 import sql
+import psycopg2.errors
 import psycopg2.extras
 from utils.utils import get_from_env
 from utils.log import get_logger
@@ -14,18 +19,230 @@ import pandas as pd
 from spider import Spider
 
 
+# Postgres truncates identifiers to 63 bytes
+MAX_IDENTIFIER_BYTES = 63
+
+
+def pg_identifier(name):
+    """Returns `name` as Postgres stores it, e.g. truncated to 63 bytes."""
+    return name.encode('utf-8')[:MAX_IDENTIFIER_BYTES].decode('utf-8', 'ignore')
+
+
+class SchemaRegistry:
+    """
+    In-process cache of the columns of every table in the `public` schema, loaded with
+    a single catalog query on first use. Code running DDL calls `invalidate`, after which
+    the table is read again on its next lookup and its `version` changes.
+    """
+    name = "SchemaRegistry"
+    logger = get_logger(name)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tables = None
+        self.stale = set()
+        self.versions = {}
+
+    def _load(self, cur, table=None):
+        query = """
+            SELECT table_name, column_name, data_type
+            FROM information_schema.columns
+            WHERE table_schema = 'public'{}
+            ORDER BY table_name, ordinal_position;
+        """
+        if table is None:
+            cur.execute(query.format(""))
+        else:
+            cur.execute(query.format(" AND table_name = %s"), (table,))
+        tables = {}
+        for table_name, column_name, data_type in cur.fetchall():
+            tables.setdefault(table_name, {})[column_name] = data_type
+        return tables
+
+    def columns(self, cur, table):
+        """Returns {column: type} of `table`, or None if there is no such table."""
+        with self.lock:
+            if self.tables is None:
+                self.tables = self._load(cur)
+                self.stale.clear()
+                self.logger.info("Loaded the schema of %d tables.", len(self.tables))
+            elif table in self.stale:
+                self.tables.pop(table, None)
+                self.tables.update(self._load(cur, table))
+                self.stale.discard(table)
+            return self.tables.get(table)
+
+    def version(self, table):
+        return self.versions.get(table, 0)
+
+    def invalidate(self, table):
+        with self.lock:
+            self.stale.add(table)
+            self.versions[table] = self.version(table) + 1
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of at most `maxconn` Postgres connections.
+    `acquire` blocks up to `timeout` seconds while all connections are in use, and
+    connections idle for longer than `check_interval` seconds are checked with `SELECT 1`
+    before they are handed out, so a connection dropped by the server is replaced.
+    Acquire waits and hold times are counted, see `stats`.
+    e.g.
+        with pool.connection(autocommit=False) as conn:
+            ...  # committed on success, rolled back on error
+    """
+    name = "ConnectionPool"
+    logger = get_logger(name)
+
+    def __init__(self, dsn=None, minconn=1, maxconn=10, timeout=30.0, check_interval=30.0):
+        self.dsn = dsn or get_from_env("POSTGRES_URL")
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self.pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, self.dsn)
+        self.schema = SchemaRegistry()
+        # ThreadedConnectionPool fails instead of waiting when exhausted
+        self.slots = threading.BoundedSemaphore(maxconn)
+        self.lock = threading.Lock()
+        self.last_used = {}
+        self.acquired_at = {}
+        self.acquires = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.hold_total = 0.0
+        self.hold_max = 0.0
+        self.replaced = 0
+
+    def acquire(self, autocommit=True):
+        started = time.perf_counter()
+        if not self.slots.acquire(timeout=self.timeout):
+            raise psycopg2.pool.PoolError(f"No connection available within {self.timeout}s")
+        try:
+            conn = self._checkout()
+            conn.autocommit = autocommit
+        except Exception:
+            self.slots.release()
+            raise
+        now = time.perf_counter()
+        with self.lock:
+            self.acquires += 1
+            self.wait_total += now - started
+            self.wait_max = max(self.wait_max, now - started)
+            self.acquired_at[id(conn)] = now
+        return conn
+
+    def _checkout(self):
+        while True:
+            conn = self.pool.getconn()
+            if not conn.closed and self._healthy(conn):
+                return conn
+            self.logger.info("Replacing a broken database connection.")
+            self.replaced += 1
+            self.last_used.pop(id(conn), None)
+            self.pool.putconn(conn, close=True)
+
+    def _healthy(self, conn):
+        if time.monotonic() - self.last_used.get(id(conn), 0) < self.check_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            return False
+
+    def release(self, conn):
+        """Returns a connection, rolling back whatever transaction it left open."""
+        now = time.perf_counter()
+        with self.lock:
+            held = now - self.acquired_at.pop(id(conn), now)
+            self.hold_total += held
+            self.hold_max = max(self.hold_max, held)
+        try:
+            if not conn.closed and conn.status != psycopg2.extensions.STATUS_READY:
+                conn.rollback()
+        except psycopg2.Error:
+            pass
+        if conn.closed:
+            self.last_used.pop(id(conn), None)
+        else:
+            self.last_used[id(conn)] = time.monotonic()
+        self.pool.putconn(conn, close=bool(conn.closed))
+        self.slots.release()
+
+    @contextmanager
+    def connection(self, autocommit=True):
+        """Borrows a connection, in transaction mode committed on success and rolled back on error."""
+        conn = self.acquire(autocommit)
+        try:
+            yield conn
+            if not autocommit:
+                conn.commit()
+        finally:
+            self.release(conn)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': self.maxconn,
+                'in_use': len(self.acquired_at),
+                'acquires': self.acquires,
+                'replaced': self.replaced,
+                'wait_avg': self.wait_total / self.acquires if self.acquires else 0.0,
+                'wait_max': self.wait_max,
+                'hold_avg': self.hold_total / self.acquires if self.acquires else 0.0,
+                'hold_max': self.hold_max,
+            }
+
+    def close(self):
+        self.pool.closeall()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(dsn=None, **kwargs):
+    """Returns the process-wide pool of `dsn`, created with `kwargs` on first use."""
+    dsn = dsn or get_from_env("POSTGRES_URL")
+    with _pools_lock:
+        if dsn not in _pools:
+            _pools[dsn] = ConnectionPool(dsn, **kwargs)
+        return _pools[dsn]
+
+
+def close_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.logger.info("Connection pool: %s", pool.stats())
+            pool.close()
+        _pools.clear()
+
+
 class DB:
+    """
+    Database access over a connection borrowed from the process-wide pool, returned on
+    `close` or when leaving the `with` block. With `autocommit=False` statements run in a
+    transaction committed on a clean exit of the `with` block.
+    """
     name = "DB"
     logger = get_logger(name)
 
-    def __init__(self, conn_string: str = None):
-        self.conn, self.cur = self.connect(conn_string)
-        self.conn.autocommit = True
+    def __init__(self, conn_string: str = None, autocommit=True, pool=None):
+        self.pool = pool or get_pool(conn_string)
+        self.schema = self.pool.schema
+        self.autocommit = autocommit
+        self.conn = self.pool.acquire(autocommit)
+        self.cur = self.conn.cursor()
 
     def __enter__(self):
         return self
 
     def table_exists(self, table_name):
+        if self.schema.columns(self.cur, table_name) is not None:
+            return True
         self.cur.execute("select exists"
                          "(select table_name "
                          "from information_schema.tables "
@@ -47,25 +264,75 @@ class DB:
         )
         self.cur.execute(query)
         self.conn.commit()
+        self.schema.invalidate(name)
 
-    def construct_and_create_table(self, table_name, field_names):
+    def column_type(self, col, values=None):
+        """Postgres type of a column, by its name or else by the dtype of its `values`."""
+        if isinstance(col, int):
+            return "INTEGER"
+        elif col == 'datetime':
+            return "DATE"
+        elif col == 'price':
+            return "BIGINT"
+        elif col == 'id':
+            return "CHAR(64) PRIMARY KEY"
+        # an all-empty column tells nothing about its type yet
+        elif values is None or values.isna().all():
+            return "TEXT"
+        elif pd.api.types.is_bool_dtype(values):
+            return "BOOLEAN"
+        elif pd.api.types.is_integer_dtype(values):
+            return "BIGINT"
+        elif pd.api.types.is_float_dtype(values):
+            return "DOUBLE PRECISION"
+        elif pd.api.types.is_datetime64_any_dtype(values):
+            return "TIMESTAMP"
+        return "TEXT"
+
+    def construct_and_create_table(self, table_name, field_names, df=None):
         fields = tuple()
 
         for col in field_names:
-            if isinstance(col, int):
-                col_type = "INTEGER"
-            elif col == 'datetime':
-                col_type = "DATE"
-            elif col == 'price':
-                col_type = "BIGINT"
-            elif col == 'id':
-                col_type = "CHAR(64) PRIMARY KEY"
-            else:
-                col_type = "TEXT"
+            col_type = self.column_type(col, df[col] if df is not None else None)
             _t = (col, col_type)
             fields += (_t,)
         self.create_table(table_name, fields)
 
+    def add_columns(self, table_name, columns):
+        """Adds columns in a single ALTER TABLE, e.g. columns = (("col1", "TEXT"), ...)"""
+        query = sql.SQL("ALTER TABLE {tbl_name} {fields};").format(
+            tbl_name=sql.Identifier(table_name),
+            fields=sql.SQL(', ').join(
+                sql.SQL("ADD COLUMN IF NOT EXISTS {} {}").format(sql.Identifier(col), sql.SQL(col_type))
+                for col, col_type in columns)
+        )
+        self.cur.execute(query)
+        self.conn.commit()
+        self.schema.invalidate(table_name)
+        self.logger.info("Added columns to %s: %s", table_name, ", ".join(col for col, _ in columns))
+
+    def evolve_table(self, table_name, df):
+        """
+        Creates `table_name` for the columns of `df`, or adds the columns it lacks.
+        Table definitions come from the schema registry, so this costs no catalog
+        queries unless the table changes. Returns the columns of `df` to insert.
+        """
+        columns = self.schema.columns(self.cur, table_name)
+        if columns is None:
+            try:
+                self.construct_and_create_table(table_name, df.columns, df)
+            except psycopg2.errors.UniqueViolation:
+                # another process created it at the same time, IF NOT EXISTS doesn't cover that
+                self.conn.rollback()
+                self.logger.info("%s was created concurrently, reading it again", table_name)
+            # it may also have existed already, created by another process with other columns
+            self.schema.invalidate(table_name)
+            columns = self.schema.columns(self.cur, table_name) or {}
+        missing = [col for col in df.columns if pg_identifier(col) not in columns]
+        if missing:
+            self.add_columns(table_name, [(col, self.column_type(col, df[col])) for col in missing])
+        return list(df.columns)
+
     def connect(self, conn_string=None):
         """ Connect to the PostgreSQL database server """
 
@@ -80,7 +347,7 @@ class DB:
             # print('Error in transaction, reverting all changes using rollback, error is: ', error)
             self.logger.log('Error while connecting to database: ', error)
 
-    def create_table_categories(self):
+    def create_table_categories(self, runtime=None):
         url = 'https://www.list.am/en/category/54'
         create_table = ('''
                         CREATE TABLE IF NOT EXISTS property_type
@@ -94,17 +361,18 @@ class DB:
                              VALUES (%s, %s)
                              ON CONFLICT (q_string) DO NOTHING;
                             '''
-        with Spider() as spider:
+        with Spider(runtime) as spider:
             categories_dict = spider.start_spider("aget_all_categories", [url])
         for key, value in categories_dict[0].items():
             print(key, value)
             self.cur.execute(insert_into_table, (key, value))
         self.conn.commit()
+        self.schema.invalidate('property_type')
 
-    def create_table_regions(self):
+    def create_table_regions(self, runtime=None):
         url = 'https://www.list.am/en/category/'
         create_table = ('''
-                        CREATE TABLE IF NOT EXISTS property_type
+                        CREATE TABLE IF NOT EXISTS regions
                           (id SERIAL PRIMARY KEY,
                           name VARCHAR(255),
                           q_string VARCHAR(16) UNIQUE);
@@ -115,11 +383,12 @@ class DB:
                           VALUES (%s, %s)
                           ON CONFLICT (q_string) DO NOTHING;
                           '''
-        with Spider() as spider:
+        with Spider(runtime) as spider:
             regions_dict = spider.start_spider("aget_all_regions", [url])
         for key, value in regions_dict[0].items():
             self.cur.execute(insert_into_table, (key, value))
         self.conn.commit()
+        self.schema.invalidate('regions')
 
     def create_table_urls(self):
         create_table = ('''
@@ -140,7 +409,7 @@ class DB:
         self.cur.execute(create_table)
         self.conn.commit()
 
-    def select_categories(self, categories: Tuple[str] = None):
+    def select_categories(self, categories: Tuple[str] = None, runtime=None):
         if self.table_exists('property_type'):
             if not categories:
                 self.cur.execute('''SELECT name, id, q_string
@@ -153,10 +422,10 @@ class DB:
             if len(cat_paths) > 0:
                 return cat_paths
         else:
-            self.create_table_categories()
-            return self.select_categories(categories)
+            self.create_table_categories(runtime)
+            return self.select_categories(categories, runtime)
 
-    def select_regions(self, regions: Tuple[str] = None):
+    def select_regions(self, regions: Tuple[str] = None, runtime=None):
         if self.table_exists('regions'):
             if not regions:
                 self.cur.execute('''SELECT name, id, q_string
@@ -169,10 +438,18 @@ class DB:
             if len(reg_paths) > 0:
                 return reg_paths
         else:
-            self.create_table_regions()
-            return self.select_regions(regions)
+            self.create_table_regions(runtime)
+            return self.select_regions(regions, runtime)
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        if self.cur and self.conn:
+    def close(self):
+        if self.conn is None:
+            return
+        if not self.cur.closed:
             self.cur.close()
-            self.conn.close()
\ No newline at end of file
+        self.pool.release(self.conn)
+        self.conn = None
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.conn is not None and not self.autocommit and exc_type is None:
+            self.conn.commit()
+        self.close()
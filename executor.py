@@ -0,0 +1,57 @@
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import metrics
+from utils.log import get_logger
+
+
+class ParseExecutor:
+    """
+    Runs CPU heavy parse functions in a process pool, keeping at most
+    `max_inflight` jobs submitted so fetched pages can't pile up in memory.
+    Functions and arguments must be picklable, e.g. `parsers.parse_item`.
+    With `max_workers=0` functions run inline, e.g. in shard workers that are processes already.
+    """
+    name = "ParseExecutor"
+    logger = get_logger(name)
+
+    def __init__(self, max_workers=None, max_inflight=None):
+        self.max_workers = (os.cpu_count() or 1) if max_workers is None else max_workers
+        self.max_inflight = max_inflight or self.max_workers * 2
+        self.pool = ProcessPoolExecutor(max_workers=self.max_workers) if self.max_workers else None
+        self.semaphore = None
+        self.loop = None
+        self.done = 0
+        self.inflight = 0
+        metrics.QUEUE_DEPTH.labels('parse').set_function(lambda: self.inflight)
+
+    def __enter__(self):
+        return self
+
+    async def run(self, func, *args):
+        if self.pool is None:
+            self.done += 1
+            return func(*args)
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            # a semaphore is bound to the loop it is first used on
+            self.loop = loop
+            self.semaphore = asyncio.Semaphore(self.max_inflight)
+        async with self.semaphore:
+            self.inflight += 1
+            try:
+                return await loop.run_in_executor(self.pool, func, *args)
+            finally:
+                self.inflight -= 1
+                self.done += 1
+
+    def stats(self):
+        return {'stage': 'parse', 'workers': self.max_workers, 'done': self.done, 'depth': self.inflight}
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
@@ -0,0 +1,108 @@
+import json
+import os
+import sqlite3
+
+from utils.log import get_logger
+
+PENDING, LEASED, DONE = 0, 1, 2
+
+
+class Frontier:
+    """
+    Disk-backed crawl frontier in a SQLite file.
+    Urls are queued once, leased in windows of at most `window` requests and marked done
+    as they finish. Done marks are written on `checkpoint`, which callers invoke once the
+    results of those requests are stored, so a restarted crawl re-runs only what wasn't
+    stored yet. Leased requests of an interrupted run are pending again on open.
+    """
+    name = "Frontier"
+    logger = get_logger(name)
+
+    def __init__(self, path='.cache/frontier.sqlite', window=5000):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.window = window
+        self.finished = []
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS requests
+              (id INTEGER PRIMARY KEY AUTOINCREMENT,
+              url TEXT UNIQUE,
+              method TEXT,
+              params TEXT,
+              state INTEGER DEFAULT 0);
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS requests_state ON requests(state, id)")
+        resumed = self.conn.execute("UPDATE requests SET state = ? WHERE state = ?", (PENDING, LEASED)).rowcount
+        self.conn.commit()
+        if resumed:
+            self.logger.info("Resuming %d interrupted requests.", resumed)
+
+    def __enter__(self):
+        return self
+
+    def push(self, url, method="GET", params=None):
+        """Queues a url unless it was queued before. Returns True if it is new."""
+        cur = self.conn.execute("INSERT OR IGNORE INTO requests (url, method, params) VALUES (?, ?, ?)",
+                                (url, method, json.dumps(params)))
+        return cur.rowcount > 0
+
+    def push_many(self, urls, method="GET", params=None):
+        params = json.dumps(params)
+        self.conn.executemany("INSERT OR IGNORE INTO requests (url, method, params) VALUES (?, ?, ?)",
+                              ((url, method, params) for url in urls))
+
+    def push_requests(self, requests):
+        """Queues (url, method, params) tuples in the given order."""
+        encoded = {}
+
+        def rows():
+            for url, method, params in requests:
+                # groups share their params dict, encode it once
+                if id(params) not in encoded:
+                    encoded[id(params)] = (params, json.dumps(params))
+                yield url, method, encoded[id(params)][1]
+        self.conn.executemany("INSERT OR IGNORE INTO requests (url, method, params) VALUES (?, ?, ?)", rows())
+
+    def pop(self, n):
+        """Leases up to `n` pending requests as (url, method, params) tuples."""
+        rows = self.conn.execute("SELECT id, url, method, params FROM requests WHERE state = ? ORDER BY id LIMIT ?",
+                                 (PENDING, n)).fetchall()
+        self.conn.executemany("UPDATE requests SET state = ? WHERE id = ?", ((LEASED, row[0]) for row in rows))
+        return [(url, method, json.loads(params)) for _, url, method, params in rows]
+
+    def done(self, url):
+        self.finished.append((DONE, url))
+
+    def take_finished(self):
+        """Returns and forgets the done marks collected since the last checkpoint."""
+        finished, self.finished = self.finished, []
+        return finished
+
+    def checkpoint(self, finished=None):
+        """Persists queued urls and done marks, or only the given marks of `take_finished`."""
+        if finished is None:
+            finished = self.take_finished()
+        self.conn.executemany("UPDATE requests SET state = ? WHERE url = ?", finished)
+        self.conn.commit()
+
+    def pending_count(self):
+        return self.conn.execute("SELECT COUNT(*) FROM requests WHERE state = ?", (PENDING,)).fetchone()[0]
+
+    def clear(self):
+        """Forgets all requests, e.g. after a crawl finished, so the next one starts over."""
+        self.finished = []
+        self.conn.execute("DELETE FROM requests")
+        self.conn.commit()
+
+    def close(self):
+        # queued urls are kept, but done marks that weren't checkpointed belong to results
+        # that may not be stored yet, so their requests run again on resume
+        self.conn.commit()
+        self.conn.close()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,221 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+import types
+from collections import Counter
+
+import metrics
+from utils.log import get_logger
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    """
+    Statistical profiler sampling the stack of one thread, by default the calling one,
+    every `interval` seconds from a background thread. Stacks are dumped folded, one
+    `outer;...;inner count` line each, as read by flamegraph.pl and speedscope.
+    e.g.
+        with StackSampler() as sampler:
+            spider.start(...)
+        sampler.dump('data/crawl.folded')
+    """
+    name = "StackSampler"
+    logger = get_logger(name)
+
+    def __init__(self, interval=0.005, thread_id=None, duration=None):
+        self.interval = interval
+        self.thread_id = thread_id
+        # stop sampling after `duration` seconds, e.g. to profile the first minute of a crawl
+        self.duration = duration
+        self.stacks = Counter()
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def start(self, thread_id=None):
+        self.thread_id = thread_id or self.thread_id or threading.get_ident()
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        until = time.monotonic() + self.duration if self.duration else None
+        while not self.stopped.wait(self.interval):
+            if until is not None and time.monotonic() > until:
+                return
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def folded(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+    def dump(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(self.folded())
+        self.logger.info("Wrote %d samples of %d stacks to %s", self.samples, len(self.stacks), path)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+class LoopMonitor:
+    """
+    Instrumentation mode of the `Spider`. It does three things:
+    - Measures event loop lag with a task ticking every `interval` seconds.
+    - Times every step a callback runs between two awaits, charging the CPU time of the
+      step to the callback.
+    - Runs a watchdog thread that logs the loop thread's stack and the running
+      callback once the loop has stalled for more than `threshold` seconds.
+    With `profile` a `StackSampler` records the loop thread while the crawl runs, or for
+    its first `profile_duration` seconds, and dumps it to `profile_path`.
+    Results go to the metrics registry, `report()` sums them up per callback.
+    e.g.
+        monitor = LoopMonitor(threshold=0.1, profile=True, profile_path='data/crawl.folded')
+        with Spider(monitor=monitor) as spider:
+            ...
+        monitor.report()
+    """
+    name = "LoopMonitor"
+    logger = get_logger(name)
+
+    def __init__(self, interval=0.05, threshold=0.25, profile=False, profile_interval=0.005,
+                 profile_duration=None, profile_path=None):
+        self.interval = interval
+        self.threshold = threshold
+        self.sampler = StackSampler(profile_interval, duration=profile_duration) if profile else None
+        self.profile_path = profile_path
+        self.current = None  # name of the callback holding the loop, read by the watchdog
+        self.heartbeat = time.monotonic()
+        self.max_lag = 0.0
+        self.cpu = Counter()
+        self.calls = Counter()
+        self.slowest = {}
+        self.stalls = []
+        self.thread_id = None
+        self.stopped = threading.Event()
+        self.lag = metrics.LOOP_LAG.labels()
+
+    def wrap(self, callback, coro):
+        """Returns `coro` of `callback`, timed step by step."""
+        name = getattr(callback, '__qualname__', None) or repr(callback)
+        self.calls[name] += 1
+        return self._timed(name, coro)
+
+    @types.coroutine
+    def _timed(self, name, coro):
+        # drives the callback coroutine like `await` would, timing each step it holds the loop
+        cpu, step, stall = metrics.CALLBACK_CPU.labels(name), metrics.CALLBACK_STEP.labels(name), None
+        value, error = None, None
+        while True:
+            self.current = name
+            started, cpu_started = time.perf_counter(), time.thread_time()
+            try:
+                if error is not None:
+                    signal = coro.throw(error)
+                else:
+                    signal = coro.send(value)
+            except StopIteration as e:
+                return e.value
+            finally:
+                self.current = None
+                elapsed, cpu_time = time.perf_counter() - started, time.thread_time() - cpu_started
+                self.cpu[name] += cpu_time
+                cpu.inc(cpu_time)
+                step.observe(elapsed)
+                if elapsed > self.slowest.get(name, 0.0):
+                    self.slowest[name] = elapsed
+                if elapsed > self.threshold:
+                    stall = stall or metrics.LOOP_STALLS.labels(name)
+                    stall.inc()
+                    self.logger.warning("Callback %s blocked the event loop for %.3fs", name, elapsed)
+            try:
+                value, error = (yield signal), None
+            except GeneratorExit:
+                coro.close()
+                raise
+            except BaseException as e:
+                value, error = None, e
+
+    async def watch(self, coro):
+        """Runs `coro`, the crawl, on the running loop while monitoring it."""
+        self.thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self.stopped.clear()
+        watchdog = threading.Thread(target=self._watchdog, name=self.name, daemon=True)
+        watchdog.start()
+        if self.sampler is not None:
+            self.sampler.start(self.thread_id)
+        ticker = asyncio.ensure_future(self._tick())
+        try:
+            return await coro
+        finally:
+            ticker.cancel()
+            await asyncio.gather(ticker, return_exceptions=True)
+            self.stopped.set()
+            watchdog.join()
+            if self.sampler is not None:
+                self.sampler.stop()
+                if self.profile_path:
+                    self.sampler.dump(self.profile_path)
+
+    async def _tick(self):
+        while True:
+            scheduled = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - scheduled)
+            self.lag.observe(lag)
+            self.max_lag = max(self.max_lag, lag)
+            self.heartbeat = now
+
+    def _watchdog(self):
+        reported = None
+        while not self.stopped.wait(self.interval):
+            heartbeat = self.heartbeat
+            stalled = time.monotonic() - heartbeat - self.interval
+            if stalled <= self.threshold or reported == heartbeat:
+                continue
+            # once per stall, while it lasts, so the stack shows what blocks the loop
+            reported = heartbeat
+            frame = sys._current_frames().get(self.thread_id)
+            stack = ''.join(traceback.format_stack(frame, limit=12)) if frame is not None else ''
+            callback = self.current or 'event loop'
+            self.stalls.append({'callback': callback, 'stalled': stalled, 'stack': stack})
+            self.logger.warning("Event loop stalled for %.3fs in %s at\n%s", stalled, callback, stack)
+
+    def report(self):
+        """Per-callback calls, CPU seconds and longest step, and loop lag and stalls."""
+        return {
+            'max_lag': self.max_lag,
+            'lag_p99': min(self.lag.quantile(0.99) or 0.0, self.max_lag),
+            'stalls': [{'callback': stall['callback'], 'stalled': stall['stalled']} for stall in self.stalls],
+            'callbacks': {name: {'calls': self.calls[name], 'cpu': self.cpu[name], 'slowest_step': self.slowest.get(name)}
+                          for name in self.calls},
+        }
@@ -1,16 +1,23 @@
-import hashlib
+import contextlib
+import logging
 import time
-import urllib
-from datetime import datetime
+import urllib.parse
 from tqdm import tqdm
 import pandas as pd
-import re
-
-from bs4 import BeautifulSoup
 
+import metrics
+import parsers
+from cache import ResponseCache
+from executor import ParseExecutor
+from frontier import Frontier
+from runtime import CrawlerRuntime
 from spider import Spider
-from db import DB
-from pipelines import PostgresPipeline, DataCleaningPipeline
+from db import DB, close_pools
+from pipelines import PostgresPipeline, DataCleaningPipeline, ParquetPipeline
+from shards import ShardedCrawl
+from sinks import RecordSink
+from stages import Stage
+from writer import AsyncWriter
 from utils.log import get_logger
 from utils.utils import construct_urls
 
@@ -18,126 +25,216 @@ from utils.utils import construct_urls
 logger = get_logger("ETL")
 
 
-def extract_urls():
-    with DB() as db:
-        categories = db.select_categories()
-        regions = db.select_regions()
-
-    urls_list = construct_urls(categories, regions)
-
-    with Spider() as spider:
-        df_urls = pd.DataFrame(columns=['cat_id', 'reg_id', 'url'])
-
-        async def parse_urls(response, params):
-            item_base_url = "https://www.list.am/en/item/"
-            page_urls = set()
+def extract_urls(discover=True, frontier=None, chunk_size=10000, incremental=True, runtime=None, monitor=None,
+                 units=None):
+    """
+    Collects item urls from listing pages and loads them in chunks of `chunk_size`.
+    With `discover` each category and region pair is crawled from its first page by
+    following `Next >` links until listings run out, instead of requesting all 250 pages.
+    With a `frontier` an interrupted crawl continues where it stopped.
+    With `incremental` items whose listing card didn't change since the last run are
+    not marked for retrieval again.
+    Pass a `CrawlerRuntime` to reuse its connections, and an `instrument.LoopMonitor`
+    to find what stalls the crawl.
+    `units` are the category and region pairs of `construct_urls` to crawl, e.g. a shard's.
+    Returns the number of links found.
+    """
+    if units is None:
+        with DB() as db:
+            categories = db.select_categories(runtime=runtime)
+            regions = db.select_regions(runtime=runtime)
+        units = construct_urls(categories, regions, discover=discover)
+    rows = []
+    total = 0
+
+    def flush():
+        nonlocal rows, total
+        if rows:
+            columns = ['url', 'cat_id', 'reg_id', 'snippet_hash'] if incremental else ['url', 'cat_id', 'reg_id']
+            df_urls = pd.DataFrame(rows, columns=columns)
+            df_urls = df_urls.drop_duplicates(subset='url', keep='first')
+            started = time.perf_counter()
+            load_urls_todb(df_urls)
+            metrics.STAGE_LATENCY.labels('load_urls').observe(time.perf_counter() - started)
+            total += len(df_urls)
+            rows = []
+        spider.checkpoint()
+
+    # listing pages are streamed, so they bypass the response cache
+    with Spider(runtime, frontier=frontier, stream=True, monitor=monitor) as spider:
+
+        async def parse_urls(page, params):
+            item_base_url = urllib.parse.urljoin(page.url, '/en/item/')
             cat_id = params['cat_id']
             reg_id = params['reg_id']
-            nonlocal df_urls
-            html = await response.text()
-            if html:
-                for link in tqdm(re.compile(r'href="/en/item/(.*?)"').findall(html), ncols=100, desc=f"Links found on page - {params['cat_name']} in {params['reg_name']}"):
-                    try:
-                        abslink = urllib.parse.urljoin(item_base_url, link)
-                        page_urls.add(abslink)
-                    except (urllib.error.URLError, ValueError):
-                        logger.exception("Error parsing URL: %s", link)
-            df = pd.DataFrame(columns=['url'], data=page_urls)
-            df['cat_id'] = cat_id
-            df['reg_id'] = reg_id
-            df_urls = pd.concat([df_urls, df])
-            logger.info("Found %d links on the page", len(page_urls), )
-        spider.start(urls_list[1:3], parse_urls)
-
-    df_urls = df_urls.drop_duplicates(subset='url', keep='first')
-    print(f"Links found in total: {len(df_urls)}")
-
-    load_urls_todb(df_urls)
-    return df_urls
+            scanner = parsers.LinkScanner()
+            links = []
+            async for chunk in page:
+                found = scanner.feed(chunk)
+                links.extend(found)
+                if not incremental:
+                    rows.extend((item_base_url + link, cat_id, reg_id) for link in found)
+            if incremental:
+                # card fingerprints are complete only once the whole page is scanned
+                snippets = scanner.snippets()
+                rows.extend((item_base_url + link, cat_id, reg_id, snippets.get(link)) for link in links)
+            logger.info("Found %d links on the page", len(links))
+            if discover and links and scanner.next_page:
+                spider.follow(scanner.next_page, page.url, parse_urls, params)
+            if len(rows) >= chunk_size:
+                flush()
+        spider.start(units, parse_urls)
+        flush()
+
+    if frontier is not None:
+        frontier.clear()
+    print(f"Links found in total: {total}")
+    return total
 
 
 def load_urls_todb(df):
-    postgres_pl = PostgresPipeline()
-    postgres_pl.process_urls(df)
+    with PostgresPipeline() as postgres_pl:
+        postgres_pl.process_urls(df)
 
 
 
-def extract_items():
-    postgres_pl = PostgresPipeline()
-    urls_list = postgres_pl.select_not_retrieved_urls()
-    with Spider() as spider:
-        df = pd.DataFrame()
-        df_dict = {}
-
-        async def parse_item(response, params):
-            nonlocal df
-            cols = ['description', 'prepayment', 'number_of_guests', 'lease_type', 'minimum_rental_period',
-                    'noise_after_hours', 'mortgage_is_possible', 'handover_date', 'places_nearby']
-            html = await response.text(encoding="utf-8")
-            if html:
-                soup = BeautifulSoup(html, 'html.parser')
-                property_type = soup.select_one('ol li:nth-child(4) span').text
-                purchase = soup.select_one('#crumb ol div span').text
-                actual_cat_name = '_'.join([property_type, purchase]).lower().replace(' ', '_')
-
-                # titles of apartment descriptive information: e.g. construction type, floor area, number of rooms etc.
-                div_title = soup.find_all('div', {'class': 't'})
-                div_value = soup.find_all('div', class_='i')  # values of titles
-                data_dict = {div_title[i].text.strip().replace(' ', '_').lower(): div_value[i].text
-                             for i in range(len(div_title)) if
-                             div_title[i].text.strip().replace(' ', '_').lower() not in cols}
-
-                if actual_cat_name != params["cat_name"]:
-                    data_dict["cat_id"] = params["cat_id"]
-                if soup.find('meta', {'itemprop': 'priceCurrency'}) is None:
-                    currency = 'unknown'
-                else:
-                    currency = soup.find('meta', {'itemprop': 'priceCurrency'})['content']
-                if soup.find('div', class_="loc") is None:
-                    address = ''
-                else:
-                    address = soup.find('div', class_="loc").text
-                price = soup.find('span', class_='price')
-                datetime_now = datetime.now()
-                date_renewed = soup.select_one('.footer span:nth-child(3)')
-                date_posted = soup.select_one('span[itemprop="datePosted"]')
-                if date_renewed:
-                    date_str = date_renewed.text.strip().split()[1]
-                    date_obj = datetime.strptime(date_str, "%d.%m.%Y")
-                    data_dict['date_posted'] = date_obj
-                else:
-                    date_str = date_posted.text.strip().split()[1]
-                    date_obj = datetime.strptime(date_str, "%d.%m.%Y")
-                    data_dict['date_posted'] = date_obj
-                data_dict['address'] = address
-                data_dict['currency'] = currency
-                data_dict['datetime'] = datetime_now
-                if price:
-                    data_dict['price'] = price.text
-                else:
-                    price = 0
-                    data_dict['price'] = price
-                # data_dict['url_id'] = url_id
-                data_dict['reg_id'] = params["reg_id"]
-                data_dict['cat_name'] = params['cat_name']
-                try:
-                    id_string = str(price) + str(soup.select_one("#uinfo a")['href']) + str(address)
-                    id_hash = hashlib.sha256(id_string.encode('utf-8')).hexdigest()
-                    data_dict['id'] = id_hash
-                except Exception as e:
-                    price = 0
-
-                df = pd.concat([df, pd.DataFrame.from_records([data_dict])])
-                logger.info(f"dataframe is {len(df)}")
-
-        for key in urls_list:
-            spider.start(urls_list[key], parse_item)
-            df_dict[key] = df
-            df = pd.DataFrame()
-
-    df_dict = clean_dataframe(df_dict)
-    load_items_todb(df_dict)
-    return df_dict
+def clean_batch(df, table_name):
+    cleaning_pl = DataCleaningPipeline()
+    cleaning_pl.df = df
+    return cleaning_pl.clean_df()
+
+
+def extract_items(chunk_size=1000, keep_frames=False, parse_workers=None, cache=None, frontier=None,
+                  incremental=True, output_pl=None, clean_workers=2, loaders=2, max_age=5.0, runtime=None,
+                  monitor=None, units=None):
+    """
+    Crawls not yet retrieved items of all categories at once as a staged pipeline:
+    fetched pages are parsed in a pool of `parse_workers` processes, chunks of parsed items
+    are cleaned by `clean_workers` threads and loaded by a background writer with
+    `loaders` connections. Stages are connected by bounded queues, so a slow stage slows
+    the crawl down instead of piling up data, and chunks are flushed at least every
+    `max_age` seconds, so rows show up in the database while the crawl goes on.
+    With a `frontier` an interrupted crawl continues where it stopped.
+    With `incremental` pages whose content fingerprint matches the stored one are
+    neither parsed nor written again.
+    Chunks go to `output_pl`, `PostgresPipeline`s by default, e.g. `ParquetPipeline()`
+    for bulk runs that are analysed from files.
+    Pass a `CrawlerRuntime` to reuse its connections, and an `instrument.LoopMonitor`
+    to find what stalls the crawl.
+    `units` are category and region groups of `select_not_retrieved_urls` to crawl, e.g. a
+    shard's, all not retrieved urls by default.
+    If `keep_frames` is set, cleaned dataframes are also returned per category.
+    """
+    with contextlib.ExitStack() as stack:
+        postgres_pl = stack.enter_context(PostgresPipeline())
+        crawl_all = units is None
+        if crawl_all:
+            urls_list = postgres_pl.select_not_retrieved_urls()
+            units = [item for key in urls_list for item in urls_list[key]]
+        known_hashes = {}
+        if incremental:
+            for item in units:
+                known_hashes.update(item['hashes'])
+        fetched_hashes = []
+        held_marks = []
+        buffered = {}  # urls per category whose records are still in the sink
+        frames = {}
+
+        def clean(df, table_name):
+            df = clean_batch(df, table_name)
+            if keep_frames:
+                frames.setdefault(table_name, []).append(df)
+            return df
+
+        def on_flush(key=None):
+            # fingerprints and checkpoint are stored once the writer has loaded the flushed chunk,
+            # those of urls whose records other categories still buffer wait for their flush
+            nonlocal fetched_hashes, held_marks
+            buffered.pop(key, None)
+            waiting = set().union(*buffered.values())
+            hashes = [pair for pair in fetched_hashes if pair[0] not in waiting]
+            fetched_hashes = [pair for pair in fetched_hashes if pair[0] in waiting]
+            marks = held_marks + spider.take_finished()
+            finished = [mark for mark in marks if mark[1] not in waiting]
+            held_marks = [mark for mark in marks if mark[1] in waiting]
+
+            def commit():
+                postgres_pl.update_content_hashes(hashes)
+                spider.checkpoint(finished)
+            cleaner.call_after(commit)
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("Stages: %s", [stage.stats() for stage in (executor, cleaner, writer)])
+
+        if output_pl is not None:
+            writer_pls = [stack.enter_context(output_pl)]
+        else:
+            writer_pls = [stack.enter_context(PostgresPipeline()) for _ in range(loaders)]
+        writer = stack.enter_context(AsyncWriter(writer_pls))
+        cleaner = stack.enter_context(Stage('clean', clean, writer, workers=clean_workers))
+        executor = stack.enter_context(ParseExecutor(parse_workers))
+        spider = stack.enter_context(
+            Spider(runtime, parse_executor=executor, cache=cache, frontier=frontier, backpressure=cleaner.wait_ready,
+                   monitor=monitor))
+        sink = RecordSink(chunk_size, postgres_pl=cleaner, on_flush=on_flush, max_age=max_age)
+
+        async def parse_item(body, params):
+            if incremental:
+                content_hash, listing = await spider.parse(
+                    parsers.parse_item_incremental, body, params, known_hashes.get(params['url']))
+                fetched_hashes.append((params['url'], content_hash))
+            else:
+                listing = await spider.parse(parsers.parse_item, body, params)
+            if listing:
+                buffered.setdefault(params['cat_name'], set()).add(params['url'])
+                sink.push(params['cat_name'], listing)
+
+        spider.start(units, parse_item, interleave=True)
+        sink.flush()
+        on_flush()
+        if crawl_all and not incremental:
+            # incremental crawls mark stored urls with their content hashes, so urls given up
+            # on stay to be fetched again; a shard mustn't mark the urls of other shards
+            cleaner.call_after(postgres_pl.url_set_as_retrieved)
+
+    if frontier is not None:
+        frontier.clear()
+    return {key: pd.concat(chunks) for key, chunks in frames.items()}
+
+
+def crawl_urls_shard(units, runtime):
+    return extract_urls(units=units, runtime=runtime)
+
+
+def crawl_items_shard(units, runtime):
+    # the shards are the parse workers
+    extract_items(units=units, parse_workers=0, runtime=runtime)
+    return sum(len(unit['urls']) for unit in units)
+
+
+def extract_urls_sharded(workers=None, discover=True):
+    """
+    Collects item urls of all category and region pairs in `workers` processes.
+    Returns the number of links found.
+    """
+    with DB() as db:
+        categories = db.select_categories()
+        regions = db.select_regions()
+    units = construct_urls(categories, regions, discover=discover)
+    with PostgresPipeline() as postgres_pl:
+        postgres_pl.create_table_urls()
+    return sum(ShardedCrawl(crawl_urls_shard, workers).run(units))
+
+
+def extract_items_sharded(workers=None):
+    """
+    Crawls not yet retrieved items in `workers` processes, balanced by the number of urls
+    per category and region pair. Returns the number of urls crawled.
+    """
+    with PostgresPipeline() as postgres_pl:
+        urls_list = postgres_pl.select_not_retrieved_urls()
+    units = [item for key in urls_list for item in urls_list[key]]
+    # shards crawl incrementally, each marks the urls it stored as retrieved
+    return sum(ShardedCrawl(crawl_items_shard, workers, cost=lambda unit: len(unit['urls'])).run(units))
 
 
 def clean_dataframe(df_dict):
@@ -149,13 +246,26 @@ def clean_dataframe(df_dict):
 
 
 def load_items_todb(df_dict):
-    postgres_pl = PostgresPipeline()
-    for key in df_dict:
-        postgres_pl.process_items(df_dict[key], key)
-        postgres_pl.url_set_as_retrieved()
-
-
-def etl():
+    with PostgresPipeline() as postgres_pl:
+        for key in df_dict:
+            postgres_pl.process_items(df_dict[key], key)
+            postgres_pl.url_set_as_retrieved()
+
+
+def load_items_toparquet(df_dict, root='data/listings'):
+    with ParquetPipeline(root) as parquet_pl:
+        for key in df_dict:
+            parquet_pl.process_items(df_dict[key], key)
+
+
+def etl(metrics_port=None, metrics_path='data/metrics.prom', summary_path='data/run_summary.json', workers=None):
+    """
+    Crawls item urls and items into the database. Metrics of the run are written to
+    `metrics_path` and `summary_path` at the end, and with `metrics_port` served live
+    on http://127.0.0.1:<metrics_port>/metrics while it runs.
+    With `workers` the crawl is sharded over that many processes, without response
+    cache and frontier.
+    """
     # with DB() as db:
     #     categories = db.select_categories()
     #     regions = db.select_regions()
@@ -163,18 +273,32 @@ def etl():
     # urls_list = construct_urls(categories, regions)
 
     t1_before = time.perf_counter()
-    extract_urls()
-    extract_items()
+    if metrics_port is not None:
+        metrics.REGISTRY.serve(metrics_port)
+    try:
+        if workers:
+            extract_urls_sharded(workers)
+            extract_items_sharded(workers)
+        else:
+            with ResponseCache() as cache, CrawlerRuntime() as runtime:
+                with Frontier('.cache/frontier_urls.sqlite') as frontier:
+                    extract_urls(frontier=frontier, runtime=runtime)
+                with Frontier('.cache/frontier_items.sqlite') as frontier:
+                    extract_items(cache=cache, frontier=frontier, runtime=runtime)
+    finally:
+        close_pools()
+        metrics.RUN_SECONDS.set(time.perf_counter() - t1_before)
+        metrics.REGISTRY.write(metrics_path)
+        metrics.REGISTRY.write_summary(summary_path)
+        metrics.REGISTRY.close()
+        print(f"Run finished in {metrics.RUN_SECONDS.labels().get():.1f}s, summary in {summary_path}")
     # df = extract_urls(urls_list[1:8])
-    t1 = time.perf_counter() - t1_before
-    print(t1)
     # urls_list = load_urls_todb(df)
     # df_dict = extract_items(urls_list)
     # df_dict = clean_dataframe(df_dict)
     #
     # load_items_todb(df_dict)
 
-etl()
 
 def main():
     logger = get_logger("Main")
@@ -206,5 +330,7 @@ def main():
 
         t2 = time.perf_counter() - t2_before
         print(t2)
-# if __name__ == '__main__':
-#     main()
+
+
+if __name__ == '__main__':
+    etl()
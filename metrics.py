@@ -0,0 +1,374 @@
+import bisect
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import aiohttp
+
+from utils.log import get_logger
+
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Value:
+    __slots__ = ('value', 'function')
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def inc(self, n=1):
+        self.value += n
+
+    def dec(self, n=1):
+        self.value -= n
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        """Reads the value from `function()` when exported, e.g. a queue's `qsize`."""
+        self.function = function
+
+    def get(self):
+        return self.function() if self.function is not None else self.value
+
+    def reset(self):
+        self.value = 0
+
+    def state(self):
+        return self.value
+
+    def merge(self, state):
+        self.value += state
+
+
+class _Histogram:
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def reset(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def state(self):
+        return self.counts, self.sum, self.count
+
+    def merge(self, state):
+        counts, total, count = state
+        self.counts = [a + b for a, b in zip(self.counts, counts)]
+        self.sum += total
+        self.count += count
+
+    def quantile(self, q):
+        """Estimates the `q` quantile by interpolating inside its bucket, like Prometheus does."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                if i == len(self.bounds):
+                    return self.bounds[-1]
+                lower = self.bounds[i - 1] if i else 0.0
+                return lower + (self.bounds[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.bounds[-1]
+
+
+class Metric:
+    """
+    Metric with a child per combination of label values. Hold on to children in hot paths,
+    so recording is a single attribute update.
+    e.g.
+        ttfb = REQUEST_LATENCY.labels('ttfb')
+        ttfb.observe(0.12)
+    """
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self.children = {}
+
+    def _child(self):
+        return _Value()
+
+    def labels(self, *values):
+        values = tuple(str(value) for value in values)
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self._child()
+        return child
+
+    def inc(self, n=1):
+        self.labels().inc(n)
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def samples(self):
+        for values, child in list(self.children.items()):
+            yield _labels(self.labelnames, values), child.get()
+
+    def prometheus(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        lines += [f'{self.name}{labels} {_number(value)}' for labels, value in self.samples()]
+        return lines
+
+    def summary(self):
+        values = {','.join(key): child.get() for key, child in list(self.children.items())}
+        return values.get('') if not self.labelnames else values
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.bounds = tuple(sorted(buckets))
+
+    def _child(self):
+        return _Histogram(self.bounds)
+
+    def prometheus(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for values, child in list(self.children.items()):
+            cumulative = 0
+            for bound, count in zip(self.bounds + (float('inf'),), child.counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else _number(float(bound))
+                lines.append(f'{self.name}_bucket{_labels(self.labelnames, values, [("le", le)])} {cumulative}')
+            labels = _labels(self.labelnames, values)
+            lines.append(f'{self.name}_sum{labels} {_number(child.sum)}')
+            lines.append(f'{self.name}_count{labels} {child.count}')
+        return lines
+
+    def summary(self):
+        return {','.join(key): {
+            'count': child.count,
+            'sum': child.sum,
+            'mean': child.sum / child.count if child.count else None,
+            'p50': child.quantile(0.5),
+            'p90': child.quantile(0.9),
+            'p99': child.quantile(0.99),
+        } for key, child in list(self.children.items())}
+
+
+class Registry:
+    """
+    Metrics of a run, exported as Prometheus text, e.g. to a file picked up by the node
+    exporter or from the local endpoint of `serve`, and as a JSON run summary.
+    e.g.
+        REGISTRY.serve(9108)  # http://127.0.0.1:9108/metrics
+        REGISTRY.write('data/metrics.prom')
+        REGISTRY.write_summary('data/run_summary.json')
+    """
+    name = "Metrics"
+    logger = get_logger(name)
+
+    def __init__(self):
+        self.metrics = {}
+        self.started = time.time()
+        self.server = None
+
+    def _add(self, cls, name, help, labels, **kwargs):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(name, help, labels, **kwargs)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter, name, help, labels)
+
+    def gauge(self, name, help, labels=()):
+        return self._add(Gauge, name, help, labels)
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram, name, help, labels, buckets=buckets)
+
+    def to_prometheus(self):
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines += metric.prometheus()
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        """Zeroes all metrics in place, e.g. between benchmark phases. Children held by callers stay valid."""
+        for metric in list(self.metrics.values()):
+            for child in list(metric.children.values()):
+                child.reset()
+        self.started = time.time()
+
+    def state(self):
+        """Counter and histogram values to `merge` into another registry, e.g. of the parent process."""
+        return {name: {values: child.state() for values, child in list(metric.children.items())}
+                for name, metric in list(self.metrics.items()) if not isinstance(metric, Gauge)}
+
+    def merge(self, state):
+        """Adds the `state` of another registry to this one."""
+        for name, children in state.items():
+            metric = self.metrics.get(name)
+            if metric is None:
+                continue
+            for values, value in children.items():
+                metric.labels(*values).merge(value)
+
+    def summary(self):
+        summary = {'started': self.started, 'elapsed': time.time() - self.started}
+        summary.update((name, metric.summary()) for name, metric in list(self.metrics.items()))
+        return summary
+
+    @staticmethod
+    def _write(path, text):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # written aside and renamed, so scrapers never read half a file
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(text)
+        os.replace(tmp, path)
+
+    def write(self, path):
+        self._write(path, self.to_prometheus())
+
+    def write_summary(self, path):
+        self._write(path, json.dumps(self.summary(), indent=2, default=str))
+
+    def serve(self, port=9108, host='127.0.0.1'):
+        """Serves `/metrics` as Prometheus text and `/summary` as JSON from a background thread."""
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.startswith('/summary'):
+                    body, content_type = json.dumps(registry.summary(), default=str), 'application/json'
+                elif self.path.startswith('/metrics'):
+                    body, content_type = registry.to_prometheus(), 'text/plain; version=0.0.4'
+                else:
+                    self.send_error(404)
+                    return
+                body = body.encode()
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self.server.serve_forever, name=self.name, daemon=True).start()
+        self.logger.info("Serving metrics on http://%s:%d/metrics", host, self.server.server_port)
+        return self.server
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.counter('crawler_requests_total', 'HTTP requests sent')
+RESPONSES = REGISTRY.counter('crawler_responses_total', 'HTTP responses by status', ('status',))
+CACHE_HITS = REGISTRY.counter('crawler_cache_hits_total', 'Responses served from the cache', ('kind',))
+RETRIES = REGISTRY.counter('crawler_retries_total', 'Requests queued again after a failure')
+ERRORS = REGISTRY.counter('crawler_errors_total', 'Failed requests', ('kind',))
+RESPONSE_BYTES = REGISTRY.counter('crawler_response_bytes_total', 'Response body bytes received')
+ITEMS = REGISTRY.counter('crawler_items_total', 'Parsed items', ('category',))
+ROWS = REGISTRY.counter('crawler_rows_total', 'Rows passed through a pipeline stage', ('stage',))
+REQUEST_LATENCY = REGISTRY.histogram('crawler_request_seconds', 'Latency of HTTP request phases', ('phase',))
+STAGE_LATENCY = REGISTRY.histogram('crawler_stage_seconds', 'Latency of pipeline stages per page or batch',
+                                   ('stage',))
+QUEUE_DEPTH = REGISTRY.gauge('crawler_queue_depth', 'Requests or batches waiting in a queue', ('queue',))
+RUN_SECONDS = REGISTRY.gauge('crawler_run_seconds', 'Duration of the last run')
+LOOP_LAG = REGISTRY.histogram('crawler_loop_lag_seconds', 'Delay of event loop ticks behind schedule')
+LOOP_STALLS = REGISTRY.counter('crawler_loop_stalls_total', 'Event loop stalls past the threshold by callback',
+                               ('callback',))
+CALLBACK_CPU = REGISTRY.counter('crawler_callback_cpu_seconds_total', 'CPU time spent in spider callbacks',
+                                ('callback',))
+CALLBACK_STEP = REGISTRY.histogram('crawler_callback_step_seconds',
+                                   'Time a callback held the event loop between two awaits', ('callback',))
+
+
+def trace_config():
+    """
+    `aiohttp.TraceConfig` timing DNS lookups, connection setup and time to response headers
+    of every request of a session.
+    """
+    dns = REQUEST_LATENCY.labels('dns')
+    connect = REQUEST_LATENCY.labels('connect')
+    ttfb = REQUEST_LATENCY.labels('ttfb')
+    clock = time.perf_counter
+
+    async def on_request_start(session, ctx, params):
+        ctx.started = clock()
+
+    async def on_dns_resolvehost_start(session, ctx, params):
+        ctx.dns_started = clock()
+
+    async def on_dns_resolvehost_end(session, ctx, params):
+        dns.observe(clock() - ctx.dns_started)
+
+    async def on_connection_create_start(session, ctx, params):
+        ctx.connect_started = clock()
+
+    async def on_connection_create_end(session, ctx, params):
+        connect.observe(clock() - ctx.connect_started)
+
+    async def on_request_end(session, ctx, params):
+        # sent once the response headers are read
+        ttfb.observe(clock() - ctx.started)
+
+    config = aiohttp.TraceConfig()
+    config.on_request_start.append(on_request_start)
+    config.on_dns_resolvehost_start.append(on_dns_resolvehost_start)
+    config.on_dns_resolvehost_end.append(on_dns_resolvehost_end)
+    config.on_connection_create_start.append(on_connection_create_start)
+    config.on_connection_create_end.append(on_connection_create_end)
+    config.on_request_end.append(on_request_end)
+    return config
@@ -0,0 +1,377 @@
+import hashlib
+import re
+import sys
+from datetime import datetime
+from html import unescape
+from pathlib import Path
+
+from bs4 import BeautifulSoup
+
+from records import Listing
+
+# item attributes that are not stored
+SKIP_COLS = ['description', 'prepayment', 'number_of_guests', 'lease_type', 'minimum_rental_period',
+             'noise_after_hours', 'mortgage_is_possible', 'handover_date', 'places_nearby']
+
+
+def parse_item_bs4(html, params):
+    """
+    Parses an item page into a record of its attributes with BeautifulSoup.
+    Reference implementation for `parse_item_fast`.
+    """
+    if isinstance(html, bytes):
+        html = html.decode('utf-8')
+    if not html:
+        return
+    soup = BeautifulSoup(html, 'html.parser')
+    property_type = soup.select_one('ol li:nth-child(4) span').text
+    purchase = soup.select_one('#crumb ol div span').text
+    actual_cat_name = '_'.join([property_type, purchase]).lower().replace(' ', '_')
+
+    # titles of apartment descriptive information: e.g. construction type, floor area, number of rooms etc.
+    div_title = soup.find_all('div', {'class': 't'})
+    div_value = soup.find_all('div', class_='i')  # values of titles
+    data_dict = {div_title[i].text.strip().replace(' ', '_').lower(): div_value[i].text
+                 for i in range(len(div_title)) if
+                 div_title[i].text.strip().replace(' ', '_').lower() not in SKIP_COLS}
+
+    if actual_cat_name != params["cat_name"]:
+        data_dict["cat_id"] = params["cat_id"]
+    if soup.find('meta', {'itemprop': 'priceCurrency'}) is None:
+        currency = 'unknown'
+    else:
+        currency = soup.find('meta', {'itemprop': 'priceCurrency'})['content']
+    if soup.find('div', class_="loc") is None:
+        address = ''
+    else:
+        address = soup.find('div', class_="loc").text
+    price = soup.find('span', class_='price')
+    datetime_now = datetime.now()
+    date_renewed = soup.select_one('.footer span:nth-child(3)')
+    date_posted = soup.select_one('span[itemprop="datePosted"]')
+    if date_renewed:
+        date_str = date_renewed.text.strip().split()[1]
+    else:
+        date_str = date_posted.text.strip().split()[1]
+    data_dict['date_posted'] = datetime.strptime(date_str, "%d.%m.%Y")
+    data_dict['address'] = address
+    data_dict['currency'] = currency
+    data_dict['datetime'] = datetime_now
+    if price:
+        data_dict['price'] = price.text
+    else:
+        price = 0
+        data_dict['price'] = price
+    data_dict['reg_id'] = params["reg_id"]
+    data_dict['cat_name'] = params['cat_name']
+    try:
+        id_string = str(price) + str(soup.select_one("#uinfo a")['href']) + str(address)
+        data_dict['id'] = hashlib.sha256(id_string.encode('utf-8')).hexdigest()
+    except Exception:
+        pass
+    return data_dict
+
+
+# tags html.parser treats as empty elements
+VOID_TAGS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen', 'link', 'menuitem', 'meta',
+             'param', 'source', 'track', 'wbr', 'basefont', 'bgsound', 'command', 'frame', 'image', 'isindex',
+             'nextid', 'spacer'}
+RAW_TAGS = {'script', 'style'}
+
+_token_re = re.compile(r'<!--.*?-->|<(/?)([a-zA-Z][^\s/>]*)((?:[^>"\']|"[^"]*"|\'[^\']*\')*)>', re.S)
+_attr_re = re.compile(r'([^\s=/>]+)(?:\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>]+)))?')
+_skip_re = re.compile(r'<!--.*?-->|<(script|style)\b.*?</\1\s*>', re.S | re.I)
+_tag_re = re.compile(r'</?[a-zA-Z](?:[^>"\']|"[^"]*"|\'[^\']*\')*>')
+
+# node fields
+TAG, ATTRS, START, END, PARENT, NTH = range(6)
+
+
+def _scan(html):
+    """
+    Tokenizes the page into a flat list of element nodes in document order, nesting them
+    the way html.parser does: an end tag closes the latest open element with that name.
+    Each node is [tag, attrs, inner_start, inner_end, parent, nth_child].
+    """
+    nodes = []
+    stack = []  # indexes of open nodes
+    counts = [0]  # element children seen, per open node (plus the document)
+    pos = 0
+    while True:
+        m = _token_re.search(html, pos)
+        if m is None:
+            break
+        pos = m.end()
+        closing, tag = m.group(1), m.group(2)
+        if tag is None:  # comment
+            continue
+        tag = tag.lower()
+        if closing:
+            for depth in range(len(stack) - 1, -1, -1):
+                if nodes[stack[depth]][TAG] == tag:
+                    for i in stack[depth:]:
+                        nodes[i][END] = m.start()
+                    del stack[depth:]
+                    del counts[depth + 1:]
+                    break
+            continue
+        counts[-1] += 1
+        attrs = m.group(3)
+        node = [tag, attrs, pos, pos, stack[-1] if stack else -1, counts[-1]]
+        nodes.append(node)
+        if tag in RAW_TAGS:
+            end = html.find('</', pos)
+            while end != -1 and html[end + 2:end + 2 + len(tag)].lower() != tag:
+                end = html.find('</', end + 2)
+            end = len(html) if end == -1 else end
+            node[END] = end
+            pos = html.find('>', end) + 1 or len(html)
+        elif tag not in VOID_TAGS and not attrs.endswith('/'):
+            node[END] = len(html)
+            stack.append(len(nodes) - 1)
+            counts.append(0)
+    return nodes
+
+
+def _attrs(node):
+    attrs = {}
+    for m in _attr_re.finditer(node[ATTRS]):
+        name = m.group(1).lower()
+        if name == '/':
+            continue
+        value = m.group(2)
+        if value is None:
+            value = m.group(3) if m.group(3) is not None else (m.group(4) or '')
+        attrs[name] = unescape(value)
+    return attrs
+
+
+def _classes(node):
+    return _attrs(node).get('class', '').split() if 'class' in node[ATTRS].lower() else []
+
+
+def _text(html, node):
+    fragment = html[node[START]:node[END]]
+    if '<' in fragment:
+        fragment = _tag_re.sub('', _skip_re.sub('', fragment))
+    return unescape(fragment)
+
+
+def _ancestor(nodes, node, match):
+    parent = node[PARENT]
+    while parent != -1:
+        if match(nodes[parent]):
+            return nodes[parent]
+        parent = nodes[parent][PARENT]
+
+
+def _serialize(html, node):
+    """Renders a text-only element the way `str(tag)` does in BeautifulSoup."""
+    inner = html[node[START]:node[END]]
+    if '<' in inner:
+        raise ValueError("Element has children: %s" % node[TAG])
+    out = '<' + node[TAG]
+    for name, value in sorted(_attrs(node).items()):
+        if name == 'class':
+            value = ' '.join(value.split())
+        value = value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+        if '"' in value:
+            if "'" in value:
+                value = '"%s"' % value.replace('"', '&quot;')
+            else:
+                value = "'%s'" % value
+        else:
+            value = '"%s"' % value
+        out += ' %s=%s' % (name, value)
+    text = unescape(inner).replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+    return out + '>' + text + '</' + node[TAG] + '>'
+
+
+def parse_item_fast(html, params):
+    """
+    Parses an item page into the same record as `parse_item_bs4` from a single tokenizer
+    pass, without building a BeautifulSoup tree.
+    """
+    if isinstance(html, bytes):
+        html = html.decode('utf-8')
+    if not html:
+        return
+    nodes = _scan(html)
+    spans = [n for n in nodes if n[TAG] == 'span']
+
+    def first(candidates, test):
+        return next((n for n in candidates if test(n)), None)
+
+    def has_id(value):
+        return lambda n: 'id' in n[ATTRS] and _attrs(n).get('id') == value
+
+    # ol li:nth-child(4) span
+    node = first(spans, lambda n: _ancestor(
+        nodes, n, lambda li: li[TAG] == 'li' and li[NTH] == 4 and _ancestor(nodes, li, lambda ol: ol[TAG] == 'ol')))
+    property_type = _text(html, node)
+    # #crumb ol div span
+    node = first(spans, lambda n: _ancestor(nodes, n, lambda div: div[TAG] == 'div' and _ancestor(
+        nodes, div, lambda ol: ol[TAG] == 'ol' and _ancestor(nodes, ol, has_id('crumb')))))
+    purchase = _text(html, node)
+    actual_cat_name = '_'.join([property_type, purchase]).lower().replace(' ', '_')
+
+    divs = [(n, _classes(n)) for n in nodes if n[TAG] == 'div']
+    div_title = [n for n, classes in divs if 't' in classes]
+    div_value = [n for n, classes in divs if 'i' in classes]
+    data_dict = {}
+    for i in range(len(div_title)):
+        title = _text(html, div_title[i]).strip().replace(' ', '_').lower()
+        if title not in SKIP_COLS:
+            data_dict[title] = _text(html, div_value[i])
+
+    if actual_cat_name != params["cat_name"]:
+        data_dict["cat_id"] = params["cat_id"]
+    meta = first(nodes, lambda n: n[TAG] == 'meta' and _attrs(n).get('itemprop') == 'priceCurrency')
+    currency = 'unknown' if meta is None else _attrs(meta)['content']
+    loc = next((n for n, classes in divs if 'loc' in classes), None)
+    address = '' if loc is None else _text(html, loc)
+    price = first(spans, lambda n: 'price' in _classes(n))
+    datetime_now = datetime.now()
+    date_renewed = first(spans, lambda n: n[NTH] == 3 and _ancestor(nodes, n, lambda f: 'footer' in _classes(f)))
+    date_posted = first(spans, lambda n: _attrs(n).get('itemprop') == 'datePosted')
+    date_str = _text(html, date_renewed or date_posted).strip().split()[1]
+    data_dict['date_posted'] = datetime.strptime(date_str, "%d.%m.%Y")
+    data_dict['address'] = address
+    data_dict['currency'] = currency
+    data_dict['datetime'] = datetime_now
+    data_dict['price'] = 0 if price is None else _text(html, price)
+    data_dict['reg_id'] = params["reg_id"]
+    data_dict['cat_name'] = params['cat_name']
+    link = first(nodes, lambda n: n[TAG] == 'a' and _ancestor(nodes, n, has_id('uinfo')))
+    href = None if link is None else _attrs(link).get('href')
+    if href is not None:
+        id_string = str(0 if price is None else _serialize(html, price)) + str(href) + str(address)
+        data_dict['id'] = hashlib.sha256(id_string.encode('utf-8')).hexdigest()
+    return data_dict
+
+
+def parse_item(html, params):
+    """
+    Parses an item page into a `Listing`.
+    Uses the fast extractor and falls back to BeautifulSoup for pages it can't handle.
+    Module level, so it can be pickled and run in a process pool.
+    """
+    try:
+        data_dict = parse_item_fast(html, params)
+    except Exception:
+        data_dict = parse_item_bs4(html, params)
+    return Listing.from_dict(data_dict)
+
+
+class LinkScanner:
+    """
+    Finds item links of a listing page in its bytes as they arrive, across chunk boundaries.
+    Only an unfinished item card or a short overlap is kept between chunks, at most
+    `max_card` bytes, so memory doesn't depend on the page size. A card's fingerprint
+    covers its price, title and picture, a changed one means the item page has to be
+    fetched again. The `Next >` link is read as by `Spider.fetch_next_page_urls`.
+    e.g.
+        scanner = LinkScanner()
+        async for chunk in stream:
+            for link in scanner.feed(chunk):
+                ...  # '12345' as in /en/item/12345
+        scanner.snippets()
+    """
+    item_re = re.compile(rb'href="/en/item/([^"]*)"[^>]*>(.*?)</a>', re.S)
+    next_re = re.compile(rb'href="([^"]*)">Next >')
+    marker = b'href="/en/item/'
+
+    def __init__(self, max_card=65536, overlap=512):
+        self.max_card = max_card
+        self.overlap = overlap
+        self.buffer = b''
+        self.cards = {}
+        self.next_page = None
+
+    def feed(self, chunk):
+        """Scans the next chunk of the page, returns links seen for the first time."""
+        buffer = self.buffer + chunk
+        links = []
+        end = 0
+        for match in self.item_re.finditer(buffer):
+            link = match.group(1).decode('utf-8', 'replace')
+            card = self.cards.get(link)
+            if card is None:
+                card = self.cards[link] = hashlib.blake2b(digest_size=8)
+                links.append(link)
+            card.update(match.group(2))
+            end = match.end()
+        if self.next_page is None:
+            match = self.next_re.search(buffer)
+            if match:
+                self.next_page = unescape(match.group(1).decode('utf-8', 'replace'))
+        # keep an item card that isn't complete yet, or the tail a link may start in
+        start = buffer.find(self.marker, end)
+        if start == -1 or len(buffer) - start > self.max_card:
+            start = max(end, len(buffer) - self.overlap)
+        self.buffer = buffer[start:]
+        return links
+
+    def snippets(self):
+        """Card fingerprints of all links, e.g. {'12345': 'a1b2...'}, once the page is scanned."""
+        return {link: card.hexdigest() for link, card in self.cards.items()}
+
+
+_volatile_re = re.compile(rb'<script\b.*?</script\s*>|<!--.*?-->', re.S | re.I)
+
+
+def content_hash(body):
+    """
+    Fingerprint of an item page for incremental crawls. Scripts and comments are left out,
+    since they carry per-request tokens and counters rather than listing content.
+    """
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    return hashlib.blake2b(_volatile_re.sub(b'', body), digest_size=8).hexdigest()
+
+
+def parse_item_incremental(html, params, known_hash=None):
+    """
+    Returns (content hash, record) for an item page, with no record if the page
+    is unchanged since it was fingerprinted as `known_hash`.
+    """
+    fingerprint = content_hash(html)
+    if fingerprint == known_hash:
+        return fingerprint, None
+    return fingerprint, parse_item(html, params)
+
+
+def check_parity(paths, params=None):
+    """
+    Diffs `parse_item_fast` against `parse_item_bs4` on saved item pages.
+    Returns {path: {field: (fast_value, bs4_value)}} for the pages that differ.
+    """
+    params = params or {'cat_name': '', 'cat_id': 0, 'reg_id': 0}
+    diffs = {}
+    for path in paths:
+        html = Path(path).read_bytes()
+        try:
+            expected = parse_item_bs4(html, params)
+        except Exception as e:
+            expected = {'error': type(e).__name__}
+        try:
+            actual = parse_item_fast(html, params)
+        except Exception as e:
+            actual = {'error': type(e).__name__}
+        diff = {key: (actual.get(key), expected.get(key)) for key in set(actual) | set(expected)
+                if key != 'datetime' and actual.get(key) != expected.get(key)}
+        if diff:
+            diffs[str(path)] = diff
+    return diffs
+
+
+if __name__ == '__main__':
+    # python parsers.py <dir with saved item pages>
+    corpus = sorted(Path(sys.argv[1]).glob('*.html'))
+    result = check_parity(corpus)
+    for path, diff in result.items():
+        print(path)
+        for key, (actual, expected) in sorted(diff.items()):
+            print("  %s: fast=%r bs4=%r" % (key, actual, expected))
+    print("%d/%d pages match" % (len(corpus) - len(result), len(corpus)))
+    sys.exit(1 if result else 0)
@@ -0,0 +1,121 @@
+import sys
+from operator import attrgetter
+
+import numpy as np
+import pandas as pd
+
+# attribute names shared by records with the same set of per-category fields
+_shapes = {}
+
+
+def _shape(keys):
+    keys = tuple(sys.intern(key) for key in keys)
+    return _shapes.setdefault(keys, keys)
+
+
+def _intern(value):
+    # attribute values are mostly short labels like 'Stone' or '3', repeated across listings
+    return sys.intern(value) if isinstance(value, str) and len(value) <= 64 else value
+
+
+class Listing:
+    """
+    Compact record of a scraped item: core fields in slots, per-category attributes as a
+    tuple of values next to a key tuple shared by all listings with the same attributes.
+    e.g.
+        listing = Listing.from_dict({'id': ..., 'price': '$100', 'floor_area': '85 sq.m.'})
+        listing['floor_area']
+    """
+    CORE = ('id', 'price', 'currency', 'address', 'date_posted', 'reg_id', 'cat_id', 'cat_name', 'datetime')
+    __slots__ = CORE + ('keys', 'values')
+
+    def __init__(self, id=None, price=None, currency=None, address=None, date_posted=None, reg_id=None,
+                 cat_id=None, cat_name=None, datetime=None, attrs=None):
+        self.id = id
+        self.price = price
+        self.currency = currency
+        self.address = address
+        self.date_posted = date_posted
+        self.reg_id = reg_id
+        self.cat_id = cat_id
+        self.cat_name = cat_name
+        self.datetime = datetime
+        attrs = attrs or {}
+        self.keys = _shape(attrs)
+        self.values = tuple(_intern(value) for value in attrs.values())
+
+    @classmethod
+    def from_dict(cls, data):
+        """Builds a listing from a parser record, fields outside CORE become attributes."""
+        if data is None:
+            return None
+        core = {key: data[key] for key in cls.CORE if key in data}
+        attrs = {key: value for key, value in data.items() if key not in core}
+        return cls(attrs=attrs, **core)
+
+    @property
+    def attrs(self):
+        return dict(zip(self.keys, self.values))
+
+    def to_dict(self):
+        data = {key: getattr(self, key) for key in self.CORE if getattr(self, key) is not None}
+        data.update(zip(self.keys, self.values))
+        return data
+
+    def __getitem__(self, key):
+        if key in self.CORE:
+            return getattr(self, key)
+        try:
+            return self.values[self.keys.index(key)]
+        except ValueError:
+            raise KeyError(key) from None
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __eq__(self, other):
+        return isinstance(other, Listing) and self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        return f"Listing({self.to_dict()!r})"
+
+    def __reduce__(self):
+        # unpickled in the parent process, so keys and values are interned there again
+        return Listing.from_dict, (self.to_dict(),)
+
+
+def _column(values):
+    return np.fromiter(values, dtype=object, count=len(values))
+
+
+def to_frame(records):
+    """
+    Builds one dataframe from a batch of listings, filling columns directly instead of
+    going through a dict per row. Core fields come first, then attributes in the order
+    they were first seen. Columns that no listing has are left out.
+    """
+    if records and not isinstance(records[0], Listing):
+        return pd.DataFrame.from_records(records)
+    n = len(records)
+    columns = {}
+    for key in Listing.CORE:
+        values = list(map(attrgetter(key), records))
+        if values.count(None) < n:
+            columns[key] = _column(values)
+    by_keys = {}
+    for i, record in enumerate(records):
+        by_keys.setdefault(record.keys, []).append(i)
+    for keys, rows in by_keys.items():
+        group = zip(*(records[i].values for i in rows)) if keys else ()
+        for key, values in zip(keys, group):
+            if len(rows) == n:
+                columns[key] = _column(values)
+                continue
+            column = columns.get(key)
+            if column is None:
+                column = columns[key] = np.full(n, None, dtype=object)
+            column[rows] = _column(values)
+    return pd.DataFrame(columns).infer_objects()
@@ -0,0 +1,55 @@
+import random
+
+from utils.log import get_logger
+
+# responses worth asking again for
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+
+
+class RetryPolicy:
+    """
+    Decides whether and when a failed request is tried again.
+    Backoff is exponential with full jitter, and retries are drawn from a budget shared
+    by the whole crawl: at most `min_budget` plus `budget_ratio` of all requests made,
+    so a failing host can't turn into a retry storm.
+    """
+    name = "RetryPolicy"
+    logger = get_logger(name)
+
+    def __init__(self, max_attempts=4, base_delay=1.0, max_delay=60.0, statuses=RETRY_STATUSES, budget_ratio=0.1,
+                 min_budget=10):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.statuses = set(statuses)
+        self.budget_ratio = budget_ratio
+        self.min_budget = min_budget
+        self.requests = 0
+        self.retries = 0
+        self.exhausted = 0
+
+    def record(self):
+        """Counts a request towards the retry budget."""
+        self.requests += 1
+
+    def retryable(self, status):
+        return status in self.statuses
+
+    @property
+    def budget(self):
+        return self.min_budget + int(self.requests * self.budget_ratio) - self.retries
+
+    def allow(self, attempt):
+        """Returns True and spends budget if a request that failed on `attempt` may be retried."""
+        if attempt + 1 >= self.max_attempts:
+            return False
+        if self.budget <= 0:
+            self.exhausted += 1
+            if self.exhausted == 1:
+                self.logger.error("Retry budget exhausted, failed requests are dropped.")
+            return False
+        self.retries += 1
+        return True
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
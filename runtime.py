@@ -0,0 +1,60 @@
+import asyncio
+
+import aiohttp
+
+import metrics
+from utils.log import get_logger
+
+
+class CrawlerRuntime:
+    """
+    Event loop, connector and HTTP session shared by every crawl of a run, so keep-alive
+    connections, TLS sessions and cached DNS lookups of one phase are reused by the next.
+    In-flight requests per host are bounded by the spider's `ConcurrencyController`,
+    so the connector itself is not limited by default.
+    e.g.
+        with CrawlerRuntime() as runtime:
+            with Spider(runtime) as spider:
+                ...
+    """
+    name = "CrawlerRuntime"
+    logger = get_logger(name)
+
+    def __init__(self, limit=0, limit_per_host=0, ttl_dns_cache=300, keepalive_timeout=75.0, timeout=None):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.timeout = timeout or aiohttp.ClientTimeout(total=60 * 60 * 24)
+        self.connector_kwargs = dict(limit=limit, limit_per_host=limit_per_host, ttl_dns_cache=ttl_dns_cache,
+                                     keepalive_timeout=keepalive_timeout, enable_cleanup_closed=True)
+        # connector and session bind to the running loop, so they are made inside it
+        self.connector, self.session = self.run(self._open())
+
+    async def _open(self):
+        connector = aiohttp.TCPConnector(**self.connector_kwargs)
+        session = aiohttp.ClientSession(connector=connector, timeout=self.timeout,
+                                        trace_configs=[metrics.trace_config()])
+        return connector, session
+
+    def __enter__(self):
+        return self
+
+    def run(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    @property
+    def closed(self):
+        return self.loop.is_closed()
+
+    def close(self):
+        if self.closed:
+            return
+        if not self.session.closed:
+            self.run(self.session.close())
+            # lets SSL transports finish their shutdown before the loop goes away
+            self.run(asyncio.sleep(0.25))
+        self.loop.run_until_complete(self.loop.shutdown_asyncgens())
+        self.loop.close()
+        self.logger.info("Crawler runtime closed.")
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
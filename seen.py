@@ -0,0 +1,161 @@
+import contextlib
+import math
+import os
+from array import array
+from hashlib import blake2b
+
+from utils.log import get_logger
+
+
+@contextlib.contextmanager
+def _replacing(path):
+    """Opens `path` for writing aside and renames it into place, so an interrupted save keeps the old file."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        yield f
+    os.replace(tmp, path)
+
+
+def fingerprint(url):
+    """64-bit fingerprint of a url, never 0 since 0 marks empty slots."""
+    return int.from_bytes(blake2b(url.encode('utf-8'), digest_size=8).digest(), 'little') or 1
+
+
+class FingerprintSet:
+    """
+    Set of urls stored as 64-bit fingerprints in an open addressing hash table backed by
+    `array('Q')`, 12-24 bytes per url instead of a string object of ~80 bytes each.
+    Collisions are possible but negligible below billions of urls.
+    e.g.
+        seen = FingerprintSet()
+        seen.add(url)
+        url in seen
+    """
+    name = "FingerprintSet"
+    logger = get_logger(name)
+    max_load = 0.7
+
+    def __init__(self, capacity=1024):
+        size = 1 << max(3, math.ceil(math.log2(capacity / self.max_load)))
+        self.table = array('Q', bytes(8 * size))
+        self.mask = size - 1
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def _slot(self, fp):
+        table, mask = self.table, self.mask
+        i = fp & mask
+        while table[i] and table[i] != fp:
+            i = (i + 1) & mask
+        return i
+
+    def __contains__(self, url):
+        return self.table[self._slot(fingerprint(url))] != 0
+
+    def add(self, url):
+        """Adds `url`, returns False if it was already in the set."""
+        return self._insert(fingerprint(url))
+
+    def _insert(self, fp):
+        i = self._slot(fp)
+        if self.table[i]:
+            return False
+        self.table[i] = fp
+        self.count += 1
+        if self.count > len(self.table) * self.max_load:
+            self._grow()
+        return True
+
+    def _grow(self):
+        old = self.table
+        self.table = array('Q', bytes(16 * len(old)))
+        self.mask = len(self.table) - 1
+        for fp in old:
+            if fp:
+                self.table[self._slot(fp)] = fp
+
+    def save(self, path):
+        with _replacing(path) as f:
+            array('Q', (fp for fp in self.table if fp)).tofile(f)
+
+    @classmethod
+    def load(cls, path):
+        """Loads a set saved with `save`, or returns an empty one if there is no file."""
+        if not os.path.exists(path):
+            return cls()
+        fps = array('Q')
+        with open(path, 'rb') as f:
+            fps.frombytes(f.read())
+        seen = cls(len(fps))
+        for fp in fps:
+            seen._insert(fp)
+        return seen
+
+
+class BloomFilter:
+    """
+    Bloom filter over urls sized for `capacity` urls at false positive rate `error_rate`,
+    e.g. about 1.2 bytes per url at 1%. A false positive makes the spider skip a url
+    it hasn't seen, so use it only where that is acceptable.
+    """
+    name = "BloomFilter"
+    logger = get_logger(name)
+
+    def __init__(self, capacity=10_000_000, error_rate=0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def _positions(self, url):
+        digest = blake2b(url.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def __contains__(self, url):
+        bits = self.bits
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in self._positions(url))
+
+    def add(self, url):
+        """Adds `url`, returns False if it was (probably) already in the filter."""
+        bits = self.bits
+        added = False
+        for p in self._positions(url):
+            if not bits[p >> 3] & (1 << (p & 7)):
+                bits[p >> 3] |= 1 << (p & 7)
+                added = True
+        if added:
+            self.count += 1
+            if self.count == self.capacity:
+                self.logger.error("Bloom filter reached its capacity of %d urls.", self.capacity)
+        return added
+
+    def save(self, path):
+        with _replacing(path) as f:
+            f.write(array('Q', [self.capacity, self.size, self.hashes, self.count]).tobytes())
+            f.write(self.bits)
+
+    @classmethod
+    def load(cls, path, capacity=10_000_000, error_rate=0.001):
+        """Loads a filter saved with `save`, or returns an empty one if there is no file."""
+        if not os.path.exists(path):
+            return cls(capacity, error_rate)
+        bloom = cls.__new__(cls)
+        with open(path, 'rb') as f:
+            header = array('Q')
+            header.frombytes(f.read(32))
+            bloom.capacity, bloom.size, bloom.hashes, bloom.count = header
+            bloom.bits = bytearray(f.read())
+        bloom.error_rate = error_rate
+        return bloom
@@ -0,0 +1,135 @@
+import multiprocessing
+import os
+import queue
+import traceback
+
+import metrics
+from db import close_pools
+from runtime import CrawlerRuntime
+from utils.log import get_logger
+
+
+def plan(units, workers, cost=None):
+    """Deals units to workers, largest first to the least loaded one."""
+    cost = cost or (lambda unit: 1)
+    loads = [0] * workers
+    shares = [[] for _ in range(workers)]
+    for unit in sorted(units, key=cost, reverse=True):
+        i = loads.index(min(loads))
+        shares[i].append(unit)
+        loads[i] += cost(unit)
+    return shares
+
+
+def take(bounds, lock, index, batch):
+    """
+    Takes up to `batch` units off the head of the worker's own range of `bounds`, or,
+    once it is empty, steals half of what is left, at most `batch`, off the tail of the
+    largest other range. Returns the positions taken and whether they were stolen.
+    """
+    workers = len(bounds) // 2
+    with lock:
+        head, tail = bounds[2 * index], bounds[2 * index + 1]
+        if head < tail:
+            n = min(batch, tail - head)
+            bounds[2 * index] = head + n
+            return range(head, head + n), False
+        victim = max(range(workers), key=lambda i: bounds[2 * i + 1] - bounds[2 * i])
+        head, tail = bounds[2 * victim], bounds[2 * victim + 1]
+        if head >= tail:
+            return None, False
+        n = max(1, min(batch, (tail - head) // 2))
+        bounds[2 * victim + 1] = tail - n
+        return range(tail - n, tail), True
+
+
+def work(index, func, units, bounds, lock, batch, results):
+    """Shard worker: runs `func(units, runtime=...)` on batches of units on its own loop and session."""
+    try:
+        with CrawlerRuntime() as runtime:
+            while True:
+                positions, stolen = take(bounds, lock, index, batch)
+                if positions is None:
+                    break
+                result = func([units[i] for i in positions], runtime=runtime)
+                results.put(('progress', index, len(positions), stolen, result))
+        results.put(('done', index, metrics.REGISTRY.state()))
+    except Exception:
+        results.put(('error', index, traceback.format_exc()))
+    finally:
+        close_pools()
+
+
+class ShardedCrawl:
+    """
+    Crawls work units, e.g. category and region pairs, in `workers` processes, each with
+    its own event loop, session and database connections, so parsing uses all cores.
+    Units are dealt to workers by `cost` up front, and taken `batch` at a time. A worker
+    that runs out steals from the one with most units left, so shards finish together
+    however uneven the categories are. `func(units, runtime=...)` must be picklable,
+    e.g. a module level function. Metrics of the workers are merged into this process'
+    registry, `run` returns the results of all batches.
+    e.g.
+        links = sum(ShardedCrawl(crawl_urls_shard, workers=4).run(units))
+    """
+    name = "ShardedCrawl"
+    logger = get_logger(name)
+
+    def __init__(self, func, workers=None, batch=4, cost=None):
+        self.func = func
+        self.workers = workers or os.cpu_count() or 1
+        self.batch = batch
+        self.cost = cost
+        self.stats = {}
+
+    def run(self, units):
+        workers = max(1, min(self.workers, len(units)))
+        shares = plan(units, workers, self.cost)
+        ordered = [unit for share in shares for unit in share]
+        # spawned, so workers don't inherit the loop, pools and logging threads of this process
+        ctx = multiprocessing.get_context('spawn')
+        bounds = ctx.Array('l', 2 * workers, lock=False)
+        start = 0
+        for i, share in enumerate(shares):
+            bounds[2 * i], bounds[2 * i + 1] = start, start + len(share)
+            start += len(share)
+        lock = ctx.Lock()
+        results = ctx.Queue()
+        processes = [ctx.Process(target=work, name=f'shard-{i}',
+                                 args=(i, self.func, ordered, bounds, lock, self.batch, results))
+                     for i in range(workers)]
+        for process in processes:
+            process.start()
+        self.logger.info("Crawling %d units in %d shards", len(units), workers)
+
+        self.stats = {i: {'units': 0, 'stolen': 0} for i in range(workers)}
+        outputs, errors = [], {}
+        pending = set(range(workers))
+        while pending:
+            try:
+                message = results.get(timeout=1)
+            except queue.Empty:
+                for i in list(pending):
+                    if processes[i].exitcode not in (None, 0):
+                        errors[i] = f'exited with code {processes[i].exitcode}'
+                        pending.discard(i)
+                continue
+            kind, i = message[:2]
+            if kind == 'progress':
+                self.stats[i]['units'] += message[2]
+                self.stats[i]['stolen'] += message[2] if message[3] else 0
+                outputs.append(message[4])
+            elif kind == 'done':
+                metrics.REGISTRY.merge(message[2])
+                pending.discard(i)
+            else:
+                errors[i] = message[2]
+                pending.discard(i)
+        for process in processes:
+            process.join()
+        self.logger.info("Shards: %s", self.stats)
+        if errors:
+            for i, error in errors.items():
+                self.logger.error("Shard %d failed: %s", i, error)
+            raise RuntimeError(f"{len(errors)} of {workers} shards failed")
+        return outputs
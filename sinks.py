@@ -0,0 +1,81 @@
+import time
+
+import pandas as pd
+
+import metrics
+from records import to_frame
+from utils.log import get_logger
+
+
+class RecordSink:
+    """
+    Collects scraped records in bounded per-key buffers and flushes every full
+    chunk through the cleaning and loading pipelines, so memory depends on
+    `chunk_size` rather than on the number of crawled items.
+    With `max_age` a buffer is also flushed once its oldest record waited that many
+    seconds, so the first rows reach the database early in a long crawl.
+    Records are `Listing`s or dicts.
+    e.g. sink.push('apartments_for_sale', listing)
+    """
+    name = "RecordSink"
+    logger = get_logger(name)
+
+    def __init__(self, chunk_size=1000, cleaning_pl=None, postgres_pl=None, keep_frames=False, on_flush=None,
+                 max_age=None):
+        self.chunk_size = chunk_size
+        self.max_age = max_age
+        self.cleaning_pl = cleaning_pl
+        self.postgres_pl = postgres_pl
+        self.keep_frames = keep_frames
+        # called with the key after its records are stored, e.g. to checkpoint the crawl
+        self.on_flush = on_flush
+        self.buffers = {}
+        self.opened = {}
+        self.chunks = {}
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def push(self, key, record):
+        buffer = self.buffers.get(key)
+        if buffer is None:
+            buffer = self.buffers[key] = []
+            self.opened[key] = time.monotonic()
+        buffer.append(record)
+        self.count += 1
+        metrics.ITEMS.labels(key).inc()
+        if len(buffer) >= self.chunk_size or (
+                self.max_age is not None and time.monotonic() - self.opened[key] >= self.max_age):
+            self.flush(key)
+
+    def flush(self, key=None):
+        """Flush the buffer of `key`, or all buffers if no key is given."""
+        keys = [key] if key is not None else list(self.buffers)
+        for key in keys:
+            records = self.buffers.pop(key, None)
+            self.opened.pop(key, None)
+            if not records:
+                continue
+            df = to_frame(records)
+            if self.cleaning_pl is not None:
+                self.cleaning_pl.df = df
+                df = self.cleaning_pl.clean_df()
+            if self.postgres_pl is not None:
+                self.postgres_pl.process_items(df, key)
+            if self.keep_frames:
+                self.chunks.setdefault(key, []).append(df)
+            self.logger.info("Flushed %d records of %s", len(records), key)
+            if self.on_flush is not None:
+                self.on_flush(key)
+
+    def close(self):
+        self.flush()
+
+    def frames(self):
+        """Returns kept chunks concatenated once per key, e.g. {'apartments_for_sale': df, ...}"""
+        return {key: pd.concat(chunks) for key, chunks in self.chunks.items()}
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
@@ -1,19 +1,26 @@
-import hashlib
 import re
 import urllib
-import traceback
+from html import unescape
 from urllib.error import HTTPError
-from utils.log import get_logger
+from utils.log import get_logger, new_request_id
+import metrics
+from sinks import RecordSink
+from backlog import PipelineError
+import parsers
+from throttle import ConcurrencyController
+from retry import RetryPolicy
+from runtime import CrawlerRuntime
+from seen import FingerprintSet
 from bs4 import BeautifulSoup
 import asyncio
+import itertools
 import aiohttp
-from datetime import datetime
 import pandas as pd
 import time
 from collections import namedtuple
-from itertools import zip_longest
 
 URL_HOME = 'https://www.list.am/en'
+NEXT_PAGE_RE = re.compile(r'href="([^"]*)">Next >')
 
 DEFAULT_HEADER = {
     'User-Agent':
@@ -22,11 +29,52 @@ DEFAULT_HEADER = {
 
 
 _Request = namedtuple(
-    "Request", ["method", "url", "header", "data", "callback", "params"])
+    "Request", ["method", "url", "header", "data", "callback", "params", "attempt", "stream"], defaults=(0, None))
 
 
-def Request(method, url, header=DEFAULT_HEADER, data=None, callback=None, params=None):
-    return _Request(method=method, url=url, header=header, data=data, callback=callback, params=params)
+def Request(method, url, header=DEFAULT_HEADER, data=None, callback=None, params=None, attempt=0, stream=None):
+    return _Request(method=method, url=url, header=header, data=data, callback=callback, params=params,
+                    attempt=attempt, stream=stream)
+
+
+class BodyStream:
+    """
+    Response body handed to streaming callbacks as an async iterator of byte chunks,
+    so a page is processed while it downloads and never held whole.
+    e.g.
+        async def callback(page, params):
+            async for chunk in page:
+                ...
+    """
+
+    def __init__(self, response, url, chunk_size=16384):
+        self.response = response
+        self.url = url
+        self.chunk_size = chunk_size
+        self.waited = 0.0  # time spent waiting for chunks to arrive
+
+    def __aiter__(self):
+        return self._chunks()
+
+    async def _chunks(self):
+        if isinstance(self.response, aiohttp.ClientResponse):
+            chunks = self.response.content.iter_chunked(self.chunk_size)
+        else:
+            chunks = self._slices(await self.response.read())
+        chunks = chunks.__aiter__()
+        while True:
+            started = time.perf_counter()
+            try:
+                chunk = await chunks.__anext__()
+            except StopAsyncIteration:
+                break
+            finally:
+                self.waited += time.perf_counter() - started
+            yield chunk
+
+    async def _slices(self, body):
+        for i in range(0, len(body), self.chunk_size):
+            yield body[i:i + self.chunk_size]
 
 
 class Spider:
@@ -35,65 +83,133 @@ class Spider:
     urls = set()
     next_page_urls = []
     logger = get_logger(name)
-    df = pd.DataFrame()
     df_urls = pd.DataFrame(columns=['cat_id', 'reg_id', 'url'])
 
     def __init__(
             self,
-            conn=aiohttp.TCPConnector(limit_per_host=100, limit=0, ttl_dns_cache=300),
-            session=aiohttp.ClientSession,
-            loop=asyncio.new_event_loop(),
-            concurrent_requests=250
+            runtime=None,
+            concurrent_requests=250,
+            sink=None,
+            parse_executor=None,
+            cache=None,
+            controller=None,
+            retry=None,
+            frontier=None,
+            seen=None,
+            seen_path=None,
+            backpressure=None,
+            stream=False,
+            stream_chunk_size=16384,
+            monitor=None
     ):
-        self.total_timeout = aiohttp.ClientTimeout(total=60 * 60 * 24)
-        # self.conn = conn
-        self.loop = loop
-        if self.loop.is_closed() or not isinstance(self.loop, asyncio.BaseEventLoop):
-            self.loop = asyncio.new_event_loop()
-
+        # `runtime.CrawlerRuntime` shared between crawls, a private one is made and closed otherwise
+        self.owns_runtime = runtime is None
+        self.runtime = runtime if runtime is not None else CrawlerRuntime()
+        self.loop = self.runtime.loop
         asyncio.set_event_loop(self.loop)
-        self.session = session(loop=self.loop, timeout=self.total_timeout)
+        self.session = self.runtime.session
         self.pending = asyncio.Queue()
-        self.visited = set()
+        # seen urls, `seen.FingerprintSet` or `seen.BloomFilter`. With `seen_path` they are
+        # loaded from and saved to that file, so a later run skips urls this one queued
+        self.seen_path = seen_path
+        if seen is None:
+            seen = FingerprintSet.load(seen_path) if seen_path else FingerprintSet()
+        self.visited = seen
         self.active = []
         self.concurrent_requests = concurrent_requests
+        self.sink = sink if sink is not None else RecordSink(keep_frames=True)
+        # when set, callbacks receive the raw response body and parse it with `self.parse`
+        self.parse_executor = parse_executor
+        # persistent `cache.ResponseCache`, responses within their TTL are not requested again
+        self.cache = cache
+        # adapts in-flight requests per host, `concurrent_requests` is only the upper bound
+        self.controller = controller or ConcurrencyController(max_window=concurrent_requests)
+        self.retry_policy = retry or RetryPolicy()
+        self.delayed = set()  # retries waiting for their backoff to pass
+        self.retrying = set()
+        # disk-backed `frontier.Frontier`, `pending` then holds only a window of its requests
+        self.frontier = frontier
+        self.callback = None
+        # awaited before each request, e.g. `AsyncWriter.wait_ready` to slow down while the database catches up
+        self.backpressure = backpressure
+        # callbacks get a `BodyStream` instead of the response, unless a request says otherwise.
+        # Streamed responses bypass the cache, storing them would mean holding them whole
+        self.stream = stream
+        self.stream_chunk_size = stream_chunk_size
+        metrics.QUEUE_DEPTH.labels('pending').set_function(self.pending.qsize)
+        self.body_latency = metrics.REQUEST_LATENCY.labels('body')
+        self.parse_latency = metrics.STAGE_LATENCY.labels('parse')
+        # `instrument.LoopMonitor` watching loop lag and callbacks, e.g. to find what stalls a crawl
+        self.monitor = monitor
+        # error of a pipeline stage that stops the crawl, raised by `start`
+        self.failure = None
+        self.aborted = asyncio.Event()
 
     def __enter__(self):
         return self
 
-    async def fetch_html(self, url, **kwargs):
+    @property
+    def window(self):
+        """Current concurrency window per host, e.g. {'www.list.am': 32}"""
+        return self.controller.window()
+
+    async def fetch_html(self, url, attempt=0, **kwargs):
         headers = {
             'User-Agent':
                 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36'
         }
+        cached = self.cache.get(url) if self.cache is not None else None
+        if cached is not None:
+            if cached.fresh:
+                return await cached.text(encoding="utf-8")
+            headers.update(cached.validators())
         try:
+            self.retry_policy.record()
             async with self.session.get(url, allow_redirects=False, headers=headers, **kwargs) as response:
+                if response.status == 304 and cached is not None:
+                    self.cache.touch(url, response.headers)
+                    return await cached.text(encoding="utf-8")
                 html = await response.text(encoding="utf-8")
-        except (aiohttp.ClientError, aiohttp.http.HttpProcessingError) as e:
+        except (aiohttp.ClientError, aiohttp.http.HttpProcessingError, asyncio.TimeoutError) as e:
             self.logger.error(
                 "aiohttp exception for %s [%s]: %s",
                 url,
                 getattr(e, "status", None),
                 getattr(e, "strerror", None),
             )
+            if self.retry_policy.allow(attempt):
+                await asyncio.sleep(self.retry_policy.delay(attempt))
+                return await self.fetch_html(url, attempt + 1, **kwargs)
         except Exception as e:
             self.logger.exception(
                 "Non-aiohttp exception occured:  %s",
                 getattr(e, "__dict__", {})
             )
         else:
+            if self.retry_policy.retryable(response.status) and self.retry_policy.allow(attempt):
+                await asyncio.sleep(self.retry_policy.delay(attempt))
+                return await self.fetch_html(url, attempt + 1, **kwargs)
             if response.status >= 300:
                 self.logger.info("Nothing to fetch")
                 return
             self.logger.info("Got response [%s] for URL: %s", response.status, url)
+            if self.cache is not None:
+                self.cache.store(url, response.status, response.headers, await response.read())
             return html
 
-    def fetch_next_page_urls(self, html):
-        next_page_element = re.compile(r'href="([^"]*)">Next >').search(html)
+    def fetch_next_page_urls(self, html, page_url=URL_HOME):
+        next_page_element = NEXT_PAGE_RE.search(html)
         if next_page_element:
-            next_page_url = next_page_element.group(1)
-            url = URL_HOME + next_page_url
+            next_page_url = unescape(next_page_element.group(1))
+            url = urllib.parse.urljoin(page_url, next_page_url)
             self.next_page_urls.append(url)
+            return url
+
+    def follow(self, href, page_url, callback, params):
+        """Queues an (unescaped) link found on `page_url`, e.g. `LinkScanner.next_page`."""
+        url = urllib.parse.urljoin(page_url, href)
+        self.add_request(url, callback, params=params)
+        return url
 
     async def aget_all_regions(self, url):
         """
@@ -157,92 +273,55 @@ class Spider:
         df['reg_id'] = reg_id
         df_urls = pd.concat([self.df_urls, df])
 
+    async def parse(self, func, *args):
+        """Runs a parse function in the parse executor if there is one, inline otherwise."""
+        started = time.perf_counter()
+        try:
+            if self.parse_executor is not None:
+                return await self.parse_executor.run(func, *args)
+            return func(*args)
+        finally:
+            self.parse_latency.observe(time.perf_counter() - started)
+
     async def parse_item(self, url, **kwargs):
-        cols = ['description', 'prepayment', 'number_of_guests', 'lease_type', 'minimum_rental_period',
-                'noise_after_hours', 'mortgage_is_possible', 'handover_date', 'places_nearby']
         html = await self.fetch_html(url)
         if html:
-            soup = BeautifulSoup(html, 'html.parser')
-            property_type = soup.select_one('ol li:nth-child(4) span').text
-            purchase = soup.select_one('#crumb ol div span').text
-            actual_cat_name = '_'.join([property_type, purchase]).lower().replace(' ', '_')
-
-            # titles of apartment descriptive information: e.g. construction type, floor area, number of rooms etc.
-            div_title = soup.find_all('div', {'class': 't'})
-            div_value = soup.find_all('div', class_='i')  # values of titles
-            data_dict = {div_title[i].text.strip().replace(' ', '_').lower(): div_value[i].text
-                         for i in range(len(div_title)) if
-                         div_title[i].text.strip().replace(' ', '_').lower() not in cols}
-
-            if actual_cat_name != kwargs["cat_name"]:
-                data_dict["cat_id"] = kwargs["cat_id"]
-            if soup.find('meta', {'itemprop': 'priceCurrency'}) is None:
-                currency = 'unknown'
-            else:
-                currency = soup.find('meta', {'itemprop': 'priceCurrency'})['content']
-            if soup.find('div', class_="loc") is None:
-                address = ''
-            else:
-                address = soup.find('div', class_="loc").text
-            price = soup.find('span', class_='price')
-            datetime_now = datetime.now()
-            date_renewed = soup.select_one('.footer span:nth-child(3)')
-            date_posted = soup.select_one('span[itemprop="datePosted"]')
-            if date_renewed:
-                date_str = date_renewed.text.strip().split()[1]
-                date_obj = datetime.strptime(date_str, "%d.%m.%Y")
-                data_dict['date_posted'] = date_obj
-            else:
-                date_str = date_posted.text.strip().split()[1]
-                date_obj = datetime.strptime(date_str, "%d.%m.%Y")
-                data_dict['date_posted'] = date_obj
-            data_dict['address'] = address
-            data_dict['currency'] = currency
-            data_dict['datetime'] = datetime_now
-            if price:
-                data_dict['price'] = price.text
-            else:
-                price = 0
-                data_dict['price'] = price
-            # data_dict['url_id'] = url_id
-            data_dict['reg_id'] = kwargs["reg_id"]
-            try:
-                id_string = str(price) + str(soup.select_one("#uinfo a")['href']) + str(address)
-                id_hash = hashlib.sha256(id_string.encode('utf-8')).hexdigest()
-                data_dict['id'] = id_hash
-            except Exception as e:
-                price = 0
-                print('')
-
-            self.df = pd.concat([self.df, pd.DataFrame.from_records([data_dict])])
-            # url_set_as_retrieved(url_id)
+            listing = await self.parse(parsers.parse_item, html, kwargs)
+            self.sink.push(kwargs["cat_name"], listing)
 
     async def gather_with_concurrency(self, task, urls, n=60, **kwargs):
-        from tqdm import tqdm
         tasks = []
         semaphore = asyncio.Semaphore(n)
-        async with semaphore:
-            for url in urls:
-                t = getattr(self, task)
-                tasks.append(t(url, **kwargs))
-            pbar = tqdm(asyncio.as_completed(tasks), total=len(tasks))
-            # val = await asyncio.gather(*tasks)
-            val = [await t for t in pbar]
-        return val
+        t = getattr(self, task)
+
+        async def bounded(url):
+            async with semaphore:
+                return await t(url, **kwargs)
+
+        for url in urls:
+            tasks.append(bounded(url))
+        return await asyncio.gather(*tasks)
 
     def start_spider(self, task, urls, **kwargs):
         result = self.loop.run_until_complete(self.gather_with_concurrency(task=task, urls=urls, **kwargs))
         return result
 
-    def add_request(self, url, callback, method="GET", params=None):
-        if url in self.visited:
+    def add_request(self, url, callback, method="GET", params=None, stream=None):
+        if self.frontier is not None:
+            self.frontier.push(url, method, params)
+            return
+        if not self.visited.add(url):
             return
-        self.visited.add(url)
-        request = Request(method=method, url=url, callback=callback, params=params)
+        request = Request(method=method, url=url, callback=callback, params=params, stream=stream)
         self.pending.put_nowait(request)
-        self.logger.info("Add url: {} to queue.".format(url))
+        self.logger.info("Add url: %s to queue.", url, extra={'event': 'request', 'url': url})
 
-    def add_requests(self, urls, callbacks):
+    def add_requests(self, urls, callbacks, interleave=False):
+        """
+        Queues the urls of every group in `urls`. With `interleave` they are queued round-robin
+        across groups, so e.g. all categories are crawled at once instead of one after another.
+        """
+        groups = []
         for item in urls:
             params = {
                 'cat_id': item['cat_id'],
@@ -250,77 +329,216 @@ class Spider:
                 'cat_name': item['cat_name'],
                 'reg_name': item['reg_name']
             }
-            for url in item['urls']:
-                self.add_request(url, callbacks, params=params)
+            groups.append([(url, params) for url in item['urls']])
+        if interleave:
+            requests = (request for batch in itertools.zip_longest(*groups) for request in batch if request)
+        else:
+            requests = itertools.chain.from_iterable(groups)
+        if self.frontier is not None:
+            self.frontier.push_requests((url, "GET", params) for url, params in requests)
+            return
+        for url, params in requests:
+            self.add_request(url, callbacks, params=params)
+
+    async def dispatch(self, callback, response, params, url=None, stream=False):
+        """Calls `callback`, returns the `BodyStream` it got when streaming."""
+        if stream:
+            body = BodyStream(response, url or str(response.url), self.stream_chunk_size)
+            await self.call(callback, body, params)
+            self.body_latency.observe(body.waited)
+            return body
+        if self.parse_executor is not None:
+            # the body doesn't tell which request it came from, so params carry the url
+            started = time.perf_counter()
+            body = await response.read()
+            self.body_latency.observe(time.perf_counter() - started)
+            await self.call(callback, body, dict(params or {}, url=url or str(response.url)))
+        else:
+            await self.call(callback, response, params)
+
+    def call(self, callback, *args):
+        """Calls a spider callback, timed by the monitor if there is one."""
+        if self.monitor is not None:
+            return self.monitor.wrap(callback, callback(*args))
+        return callback(*args)
 
     async def request_with_callback(self, request: _Request, callback=None):
         if not callback:
             callback = request.callback
+        new_request_id()
         try:
-            async with self.session.request(method=request.method, url=request.url, allow_redirects=False, headers=request.header) as resp:
-                if resp.status >= 300:
-                    self.logger.info("Request redirected, nothing to fetch")
-                    return
-                await callback(resp, request.params)
-                self.logger.info("Request [{method}] `{url}` finished.(There are still {num})".format(
-                    method=request.method, url=request.url, num=self.pending.qsize()))
-        except (aiohttp.ClientError, aiohttp.http.HttpProcessingError) as e:
+            stream = self.stream if request.stream is None else request.stream
+            cached = self.cache.get(request.url) if self.cache is not None and not stream else None
+            if cached is not None and cached.fresh:
+                metrics.CACHE_HITS.labels('fresh').inc()
+                await self.dispatch(callback, cached, request.params, request.url, stream)
+                return
+            headers = request.header
+            if cached is not None:
+                headers = dict(headers, **cached.validators())
+            host = urllib.parse.urlsplit(request.url).netloc
+            await self.controller.acquire(host)
+            started, latency, status = time.monotonic(), None, None
+            self.retry_policy.record()
+            metrics.REQUESTS.inc()
+            try:
+                async with self.session.request(method=request.method, url=request.url, allow_redirects=False, headers=headers) as resp:
+                    latency = time.monotonic() - started
+                    status = resp.status
+                    metrics.RESPONSES.labels(status).inc()
+                    if resp.status == 304 and cached is not None:
+                        metrics.CACHE_HITS.labels('revalidated').inc()
+                        self.cache.touch(request.url, resp.headers)
+                        await self.dispatch(callback, cached, request.params, request.url, stream)
+                        return
+                    if self.retry_policy.retryable(resp.status):
+                        self.retry(request, resp.status)
+                        return
+                    if resp.status >= 300:
+                        self.logger.info("Request redirected, nothing to fetch")
+                        return
+                    if self.cache is not None and not stream:
+                        self.cache.store(request.url, resp.status, resp.headers, await resp.read())
+                    await self.dispatch(callback, resp, request.params, request.url, stream)
+                    metrics.RESPONSE_BYTES.inc(resp.content.total_bytes)
+                    self.logger.info("Request [%s] `%s` finished.(There are still %d)", request.method,
+                                     request.url, self.pending.qsize(),
+                                     extra={'event': 'request', 'url': request.url, 'status': resp.status})
+            finally:
+                self.controller.release(host, latency, status, error=status is None)
+        except (aiohttp.ClientError, aiohttp.http.HttpProcessingError, asyncio.TimeoutError) as e:
             self.logger.error(
                 "aiohttp exception for %s [%s]: %s",
                 request.url,
                 getattr(e, "status", None),
                 getattr(e, "strerror", None),
+                extra={'event': 'request', 'url': request.url},
             )
+            metrics.ERRORS.labels('network').inc()
+            self.retry(request, getattr(e, "status", None))
+        except PipelineError:
+            raise
         except Exception as e:
-            self.logger.error(
-                "Non-aiohttp exception occured in request [{method}]: `{url}`, request is ignored\n{error}".format(
-                    error=traceback.format_exc(), url=request.url, method=request.method)
-            )
+            metrics.ERRORS.labels('callback').inc()
+            self.logger.exception("Non-aiohttp exception occured in request [%s]: `%s`, request is ignored",
+                                  request.method, request.url, extra={'event': 'request', 'url': request.url})
         else:
             if resp.status >= 300:
                 self.logger.info("Nothing to fetch")
                 return
 
+    def retry(self, request, status=None):
+        """Queues `request` again after a backoff, if the retry policy allows it."""
+        if not self.retry_policy.allow(request.attempt):
+            metrics.ERRORS.labels('gave_up').inc()
+            self.logger.error("Giving up on `%s` after %d attempts [%s]", request.url, request.attempt + 1, status)
+            return
+        delay = self.retry_policy.delay(request.attempt)
+        metrics.RETRIES.inc()
+        task = asyncio.ensure_future(self._requeue(request._replace(attempt=request.attempt + 1), delay))
+        self.retrying.add(request.url)
+        self.delayed.add(task)
+        task.add_done_callback(self.delayed.discard)
+
+    async def _requeue(self, request, delay):
+        await asyncio.sleep(delay)
+        self.pending.put_nowait(request)
+
     async def load(self):
-        import tqdm.asyncio
         try:
             while True:
+                if self.backpressure is not None:
+                    await self.backpressure()
                 request = await self.pending.get()
-                self.logger.info("Loading url: {} from queue.".format(request.url))
+                self.logger.info("Loading url: %s from queue.", request.url,
+                                 extra={'event': 'request', 'url': request.url})
                 await self.request_with_callback(request, request.callback)
+                if self.frontier is not None:
+                    if request.url in self.retrying:
+                        self.retrying.discard(request.url)
+                    else:
+                        self.frontier.done(request.url)
+                    self.fill()
                 self.pending.task_done()
         except asyncio.CancelledError:
             pass
+        except PipelineError as e:
+            # what is fetched from now on couldn't be stored
+            if self.failure is None:
+                self.logger.error("Aborting the crawl: %s", e)
+                self.failure = e
+                self.aborted.set()
+
+    async def _drain(self):
+        await self.pending.join()
+        while self.delayed or self.fill():
+            if self.delayed:
+                await asyncio.wait(set(self.delayed))
+            await self.pending.join()
 
     async def __start(self):
         for _ in range(self.concurrent_requests):
             self.active.append(asyncio.ensure_future(
                 self.load(), loop=self.loop))
         self.logger.info("Waiting for all requests to finish.")
-        await self.pending.join()
+        self.fill()
+        drained, aborted = asyncio.ensure_future(self._drain()), asyncio.ensure_future(self.aborted.wait())
+        try:
+            await asyncio.wait({drained, aborted}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            drained.cancel()
+            aborted.cancel()
+            await asyncio.gather(drained, aborted, return_exceptions=True)
+        if self.failure is not None:
+            raise self.failure
         self.logger.info("Requests have finished.")
 
-    def start(self, urls, callbacks):
-        self.add_requests(urls, callbacks)
+    def fill(self):
+        """Tops the in-memory queue up from the frontier once it's half empty. Returns the number of requests added."""
+        if self.frontier is None or self.pending.qsize() > self.frontier.window // 2:
+            return 0
+        requests = self.frontier.pop(self.frontier.window - self.pending.qsize())
+        for url, method, params in requests:
+            self.pending.put_nowait(Request(method=method, url=url, callback=self.callback, params=params))
+        return len(requests)
+
+    def checkpoint(self, finished=None):
+        """
+        Marks finished requests as done in the frontier. Call it once their results are stored,
+        or pass the marks taken with `take_finished` when results are stored later.
+        """
+        if self.frontier is not None:
+            self.frontier.checkpoint(finished)
+
+    def take_finished(self):
+        return self.frontier.take_finished() if self.frontier is not None else []
+
+    def start(self, urls, callbacks, interleave=False):
+        self.callback = callbacks
+        self.add_requests(urls, callbacks, interleave)
         self.logger.info("Spider started.")
-        self.loop.run_until_complete(self.__start())
+        crawl = self.__start()
+        self.loop.run_until_complete(self.monitor.watch(crawl) if self.monitor is not None else crawl)
         self.logger.info("All tasks done. Spider starts to shutdown.")
 
     @staticmethod
-    def construct_url(cat_path, reg_query):
-        url = [URL_HOME + cat_path + '/' + str(i) + reg_query for i in range(1, 251)]
+    def construct_url(cat_path, reg_query, discover=False, max_pages=250):
+        pages = 1 if discover else max_pages
+        url = [URL_HOME + cat_path + '/' + str(i) + reg_query for i in range(1, pages + 1)]
         return url
 
     def _cancel(self):
-        for task in self.active:
+        tasks = self.active + list(self.delayed)
+        for task in tasks:
             task.cancel()
+        if tasks and not self.loop.is_closed():
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        self.active = []
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self._cancel()
-        if not self.session.closed:
-            self.loop.run_until_complete(self.session.close())
-        if not self.loop.is_closed():
-            self.loop.stop()
-            self.loop.run_forever()
-            self.loop.close()
+        if self.seen_path:
+            self.visited.save(self.seen_path)
+        if self.owns_runtime:
+            self.runtime.close()
         self.logger.info("Spider shutdown.")
@@ -0,0 +1,124 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import metrics
+from backlog import BacklogQueue, PipelineError
+from utils.log import get_logger
+
+_CALLBACK = object()
+_STOP = object()
+
+
+class Stage:
+    """
+    Pipeline stage running `func(df, table_name)` on batches in `workers` threads, or
+    processes with `processes=True` (then `func` must be picklable), and passing the
+    results to `downstream.process_items` in the order the batches came in.
+    At most `maxsize` batches are queued. `process_items` never blocks, as it is called on
+    the event loop, batches that don't fit wait in a backlog, and `wait_ready` waits until
+    the backlog has drained and there is room again. Once a batch failed both raise
+    `PipelineError`, which stops the `Spider`. It has the interface of `AsyncWriter`, so
+    stages chain in front of it and `call_after` barriers keep their place among the batches.
+    e.g.
+        clean = Stage('clean', clean_batch, writer, workers=4)
+        sink = RecordSink(chunk_size, postgres_pl=clean)
+    """
+    name = "Stage"
+    logger = get_logger(name)
+
+    def __init__(self, name, func, downstream, workers=1, maxsize=8, processes=False):
+        self.name = name
+        self.func = func
+        self.downstream = downstream
+        self.workers = workers
+        self.pool = ProcessPoolExecutor(workers) if processes else ThreadPoolExecutor(workers, name)
+        self.pending = BacklogQueue(maxsize)
+        self.error = None
+        self.started = time.monotonic()
+        self.batches = 0
+        self.rows = 0
+        self.latency = 0.0
+        self.max_depth = 0
+        self.latency_metric = metrics.STAGE_LATENCY.labels(name)
+        self.rows_metric = metrics.ROWS.labels(name)
+        metrics.QUEUE_DEPTH.labels(name).set_function(self.pending.qsize)
+        self.thread = threading.Thread(target=self._emit, name=name, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def process_items(self, df, table_name):
+        """Queues a batch without blocking, see `wait_ready`."""
+        self._raise()
+        self.pending.put((self.pool.submit(self.func, df, table_name), table_name, time.monotonic()))
+        self.max_depth = max(self.max_depth, self.pending.qsize())
+
+    def call_after(self, callback):
+        """Passes `callback` downstream once the batches queued so far have been."""
+        self.pending.put((_CALLBACK, callback, None))
+
+    async def wait_ready(self):
+        """Waits while this stage or a stage after it is saturated, raises once one failed."""
+        self._raise()
+        while self.pending.full():
+            await asyncio.sleep(0.05)
+            self._raise()
+        await self.downstream.wait_ready()
+
+
+    def _raise(self):
+        if isinstance(self.error, PipelineError):
+            raise self.error
+        if self.error is not None:
+            raise PipelineError(f"Stage {self.name} failed") from self.error
+
+    def _emit(self):
+        while True:
+            future, table_name, submitted = self.pending.get()
+            if future is _STOP:
+                return
+            if future is _CALLBACK:
+                if self.error is None:
+                    self.downstream.call_after(table_name)
+                continue
+            try:
+                df = future.result()
+                latency = time.monotonic() - submitted
+                self.latency += latency
+                self.latency_metric.observe(latency)
+                self.batches += 1
+                if df is not None and self.error is None:
+                    self.rows += len(df)
+                    self.rows_metric.inc(len(df))
+                    self.downstream.process_items(df, table_name)
+            except Exception as e:
+                self.logger.exception("Stage %s failed on a batch of %s", self.name, table_name)
+                self.error = self.error or e
+
+    def stats(self):
+        elapsed = time.monotonic() - self.started
+        return {
+            'stage': self.name,
+            'workers': self.workers,
+            'batches': self.batches,
+            'rows': self.rows,
+            'rows_per_s': self.rows / elapsed if elapsed else 0.0,
+            'latency_avg': self.latency / self.batches if self.batches else 0.0,
+            'depth': self.pending.qsize(),
+            'max_depth': self.max_depth,
+        }
+
+    def close(self):
+        """Passes on everything queued and stops the workers, the downstream stays open."""
+        if self.thread.is_alive():
+            self.pending.put((_STOP, None, None))
+            self.thread.join()
+        self.pool.shutdown(wait=True)
+        self.logger.info("Stage %s: %s", self.name, self.stats())
+        self._raise()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,117 @@
+import asyncio
+import time
+from collections import deque
+
+from utils.log import get_logger
+
+# responses telling us to slow down
+THROTTLE_STATUSES = {429, 500, 502, 503, 504}
+
+
+class HostWindow:
+    """Congestion window and in-flight requests of a single host."""
+
+    def __init__(self, limit):
+        self.limit = float(limit)
+        self.inflight = 0
+        self.waiters = deque()
+        self.latency = None  # moving average of response latency
+        self.base_latency = None  # lowest latency seen, i.e. latency of an unloaded host
+        self.decreased_at = 0.0
+        self.requests = 0
+        self.errors = 0
+
+
+class ConcurrencyController:
+    """
+    Adapts the number of concurrent requests per host with AIMD: the window grows by
+    `increase` requests per window of successful responses and is multiplied by `decrease`
+    on errors, 429/5xx responses or when latency rises above `latency_tolerance` times
+    its baseline. The window stays within `min_window` and `max_window`.
+    e.g.
+        await controller.acquire(host)
+        ...
+        controller.release(host, latency, status)
+    """
+    name = "ConcurrencyController"
+    logger = get_logger(name)
+
+    def __init__(self, min_window=2, max_window=250, initial_window=16, increase=1.0, decrease=0.5,
+                 latency_tolerance=3.0, cooldown=1.0, smoothing=0.2):
+        self.min_window = min_window
+        self.max_window = max_window
+        self.initial_window = min(max(initial_window, min_window), max_window)
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self.cooldown = cooldown
+        self.smoothing = smoothing
+        self.hosts = {}
+
+    def host(self, host):
+        if host not in self.hosts:
+            self.hosts[host] = HostWindow(self.initial_window)
+        return self.hosts[host]
+
+    def window(self, host=None):
+        """Current window of `host`, or of all hosts as a dictionary."""
+        if host is None:
+            return {name: int(state.limit) for name, state in self.hosts.items()}
+        return int(self.host(host).limit)
+
+    async def acquire(self, host):
+        state = self.host(host)
+        if state.inflight < int(state.limit) and not state.waiters:
+            state.inflight += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        state.waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # slot was handed over already, pass it on
+                state.inflight -= 1
+                self._wake(state)
+            elif waiter in state.waiters:
+                state.waiters.remove(waiter)
+            raise
+
+    def release(self, host, latency=None, status=None, error=False):
+        state = self.host(host)
+        state.inflight -= 1
+        state.requests += 1
+        if error or status in THROTTLE_STATUSES:
+            state.errors += 1
+            self._decrease(state, host)
+        elif latency is not None:
+            self._observe(state, latency)
+            if state.latency > state.base_latency * self.latency_tolerance:
+                self._decrease(state, host)
+            else:
+                state.limit = min(self.max_window, state.limit + self.increase / state.limit)
+        self._wake(state)
+
+    def _observe(self, state, latency):
+        if state.latency is None:
+            state.latency = state.base_latency = latency
+            return
+        state.latency += self.smoothing * (latency - state.latency)
+        # let the baseline drift up slowly, so a permanently slower host isn't throttled forever
+        state.base_latency = min(latency, state.base_latency * 1.001)
+
+    def _decrease(self, state, host):
+        now = time.monotonic()
+        # one decrease per cooldown, a burst of failures is a single congestion signal
+        if now - state.decreased_at < self.cooldown:
+            return
+        state.decreased_at = now
+        state.limit = max(self.min_window, state.limit * self.decrease)
+        self.logger.info("Window of %s decreased to %d", host, state.limit)
+
+    def _wake(self, state):
+        while state.waiters and state.inflight < int(state.limit):
+            waiter = state.waiters.popleft()
+            if not waiter.done():
+                state.inflight += 1
+                waiter.set_result(None)
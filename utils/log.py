@@ -1,5 +1,140 @@
+import atexit
+import contextvars
+import itertools
+import json
 import logging
+import logging.handlers
+import os
+import queue
 import sys
+import threading
+
+# id of the request the current task works on, added to its log records
+REQUEST_ID = contextvars.ContextVar('request_id', default=None)
+# keep 1 of every n records of these events, warnings and errors always pass
+DEFAULT_SAMPLING = {'request': 100}
+TEXT_FORMAT = "[%(asctime)s] %(levelname)-5s %(name)s %(message)s"
+DATE_FORMAT = "%Y:%m:%d %H:%M:%S"
+
+_request_ids = itertools.count(1)
+_lock = threading.Lock()
+_handler = None
+_listener = None
+
+
+def new_request_id():
+    """Starts a new request id for the current task and returns it."""
+    request_id = format(next(_request_ids), 'x')
+    REQUEST_ID.set(request_id)
+    return request_id
+
+
+class ContextFilter(logging.Filter):
+    """Adds the request id of the emitting task to the record."""
+
+    def filter(self, record):
+        record.request_id = REQUEST_ID.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Passes 1 of every n records per event, given as `extra={'event': ...}`,
+    e.g. SamplingFilter({'request': 100}). Passed records carry `sampled=n`.
+    """
+
+    def __init__(self, rates=None):
+        super().__init__()
+        self.rates = dict(rates or {})
+        self.counts = {}
+
+    def filter(self, record):
+        event = getattr(record, 'event', None)
+        n = self.rates.get(event)
+        if not n or n <= 1 or record.levelno >= logging.WARNING:
+            return True
+        count = self.counts.get(event, 0)
+        self.counts[event] = count + 1
+        if count % n:
+            return False
+        record.sampled = n
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as one JSON object per line."""
+    FIELDS = ('event', 'request_id', 'url', 'status', 'sampled')
+
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record, self.datefmt),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_info:
+            data['exc'] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Queues records for the writer thread, dropping them instead of blocking while the queue is full."""
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(level=None, json_format=None, stream=None, sampling=None, maxsize=10000):
+    """
+    Routes all logging through a bounded queue to a background thread, so writing
+    log lines never blocks the event loop. Messages are formatted only for records
+    that pass the level and sampling, and then in the emitting thread.
+    Level and format default to the LOG_LEVEL (ERROR) and LOG_FORMAT (text or json)
+    environment variables.
+    """
+    global _handler, _listener
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            logging.getLogger().removeHandler(_handler)
+        level = level or os.environ.get('LOG_LEVEL', 'ERROR')
+        if json_format is None:
+            json_format = os.environ.get('LOG_FORMAT', 'text') == 'json'
+        output = logging.StreamHandler(stream or sys.stderr)
+        output.setFormatter(JsonFormatter(datefmt=DATE_FORMAT) if json_format
+                            else logging.Formatter(TEXT_FORMAT, datefmt=DATE_FORMAT))
+        _handler = DroppingQueueHandler(queue.Queue(maxsize))
+        _handler.addFilter(ContextFilter())
+        _handler.addFilter(SamplingFilter(DEFAULT_SAMPLING if sampling is None else sampling))
+        root = logging.getLogger()
+        root.addHandler(_handler)
+        root.setLevel(level)
+        _listener = logging.handlers.QueueListener(_handler.queue, output)
+        _listener.start()
+        return _handler
+
+
+def shutdown_logging():
+    """Writes out queued records and stops the writer thread."""
+    global _listener
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+
+atexit.register(shutdown_logging)
 
 
 def get_logger(name="Logger"):
@@ -11,16 +146,6 @@ def get_logger(name="Logger"):
     Returns:
         _type_: Logger
     """
-    logging_format = f"[%(asctime)s] %(levelname)-5s %(name)-{len(name)}s "
-    # logging_format += "%(module)-7s::l%(lineno)d: "
-    # logging_format += "%(module)-7s: "
-    logging_format += "%(message)s"
-
-    logging.basicConfig(
-        format=logging_format,
-        level=logging.ERROR,
-        datefmt="%Y:%m:%d %H:%M:%S",
-        stream=sys.stderr
-    )
-    logging.getLogger("asyncio").setLevel(logging.DEBUG)
-    return logging.getLogger(name)
\ No newline at end of file
+    if _handler is None:
+        setup_logging()
+    return logging.getLogger(name)
@@ -16,11 +16,17 @@ def get_from_env(env_key: str =None) -> str:
         )
 
 
-def construct_urls(categories, regions):
+def construct_urls(categories, regions, discover=False, max_pages=250):
+    """
+    Constructs listing page urls for every category and region pair.
+    With `discover` only the first page is returned, the following ones are found
+    by following `Next >` links while crawling.
+    """
     urls_list = []
+    pages = 1 if discover else max_pages
     for cat_name, cat_id, cat_path in categories:
         for reg_name, reg_id, reg_path in regions:
-            urls = [BASE_URL + cat_path + '/' + str(i) + reg_path for i in range(1, 251)]
+            urls = [BASE_URL + cat_path + '/' + str(i) + reg_path for i in range(1, pages + 1)]
             d = {
                 "urls": urls,
                 "cat_name": cat_name,
@@ -0,0 +1,180 @@
+import asyncio
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+import metrics
+from backlog import BacklogQueue, PipelineError
+from utils.log import get_logger
+
+_CALLBACK = object()
+_STOP = object()
+
+
+class AsyncWriter:
+    """
+    Loads cleaned batches into Postgres from a background thread, so the database works
+    while the spider keeps crawling.
+    Queued batches are merged per table up to `batch_rows` rows, and `batch_rows` is tuned
+    from commit latency towards `target_latency` seconds. The queue holds at most `maxsize`
+    batches, `process_items` never blocks and keeps what doesn't fit in a backlog, and
+    `wait_ready` lets the spider pause fetching until the backlog has drained.
+    It has the `process_items` interface of `PostgresPipeline`, e.g. as `RecordSink` target.
+    Given a list of pipelines, e.g. with a pooled connection each, the tables of a batch
+    are loaded in parallel, one pipeline per table.
+    """
+    name = "AsyncWriter"
+    logger = get_logger(name)
+
+    def __init__(self, postgres_pl, maxsize=8, target_latency=1.0, batch_rows=5000, min_rows=500,
+                 max_rows=200000):
+        self.pls = list(postgres_pl) if isinstance(postgres_pl, (list, tuple)) else [postgres_pl]
+        self.loaders = ThreadPoolExecutor(len(self.pls), self.name) if len(self.pls) > 1 else None
+        self.queue = BacklogQueue(maxsize)
+        self.target_latency = target_latency
+        self.batch_rows = batch_rows
+        self.min_rows = min_rows
+        self.max_rows = max_rows
+        self.callbacks = deque()  # callbacks whose preceding batches are written
+        self.error = None
+        self.rows = 0
+        self.commits = 0
+        metrics.QUEUE_DEPTH.labels('load').set_function(self.queue.qsize)
+        self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def process_items(self, df, table_name):
+        """Queues a batch without blocking, see `wait_ready`."""
+        self._raise()
+        self.queue.put((table_name, df))
+
+    def call_after(self, callback):
+        """
+        Runs `callback` in the calling thread once all batches queued so far are written,
+        e.g. to checkpoint the crawl. Callbacks run in `wait_ready`, `run_callbacks` and `close`.
+        """
+        self.queue.put((_CALLBACK, callback))
+
+    def run_callbacks(self):
+        while self.callbacks:
+            self.callbacks.popleft()()
+
+    async def wait_ready(self):
+        """
+        Waits while the writer is saturated, raises once it failed. Pass it to the Spider
+        as `backpressure`.
+        """
+        self._raise()
+        self.run_callbacks()
+        while self.queue.full():
+            await asyncio.sleep(0.05)
+            self._raise()
+            self.run_callbacks()
+
+
+    def _raise(self):
+        if self.error is not None:
+            raise PipelineError("Writing batches failed") from self.error
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batches = {}
+            rows = 0
+            item = self.queue.get()
+            # merge whatever else is queued, up to a commit's worth of rows
+            while True:
+                if item[0] is _STOP:
+                    stop = True
+                    break
+                if item[0] is _CALLBACK:
+                    self._write(batches)
+                    batches, rows = {}, 0
+                    if self.error is None:
+                        self.callbacks.append(item[1])
+                else:
+                    batches.setdefault(item[0], []).append(item[1])
+                    rows += len(item[1])
+                if rows >= self.batch_rows:
+                    break
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            self._write(batches)
+
+    def _write(self, batches):
+        if not batches or self.error is not None:
+            return
+        started = time.perf_counter()
+        rows = 0
+        try:
+            if self.loaders is None:
+                for table_name, frames in batches.items():
+                    rows += self._load(self.pls[0], table_name, frames)
+            else:
+                tables = list(batches.items())
+                groups = [tables[i::len(self.pls)] for i in range(len(self.pls))]
+                futures = [self.loaders.submit(self._load_all, pl, group) for pl, group in zip(self.pls, groups)]
+                rows = sum(future.result() for future in futures)
+        except Exception as e:
+            self.logger.exception("Writing batch failed")
+            self.error = e
+            return
+        latency = time.perf_counter() - started
+        self.rows += rows
+        self.commits += 1
+        metrics.STAGE_LATENCY.labels('load').observe(latency)
+        metrics.ROWS.labels('load').inc(rows)
+        if latency < self.target_latency / 2 and rows >= self.batch_rows:
+            self.batch_rows = min(self.max_rows, self.batch_rows * 2)
+        elif latency > self.target_latency:
+            self.batch_rows = max(self.min_rows, self.batch_rows // 2)
+        self.logger.info("Wrote %d rows in %.3fs, batch size now %d", rows, latency, self.batch_rows)
+
+    @staticmethod
+    def _concat(frames):
+        df = pd.concat(frames)
+        # a column missing from some frames turns ints into floats, which COPY refuses for BIGINT
+        for col in df.columns:
+            if df[col].dtype.kind == 'f' and all(frame[col].dtype.kind in 'iu' for frame in frames if col in frame):
+                df[col] = df[col].astype('Int64')
+        return df
+
+    def _load(self, pl, table_name, frames):
+        df = self._concat(frames) if len(frames) > 1 else frames[0]
+        pl.process_items(df, table_name)
+        return len(df)
+
+    def _load_all(self, pl, tables):
+        return sum(self._load(pl, table_name, frames) for table_name, frames in tables)
+
+    def stats(self):
+        return {
+            'stage': 'load',
+            'workers': len(self.pls),
+            'rows': self.rows,
+            'commits': self.commits,
+            'batch_rows': self.batch_rows,
+            'depth': self.queue.qsize(),
+        }
+
+    def close(self):
+        """Writes everything queued, runs pending callbacks and stops the thread."""
+        if self.thread.is_alive():
+            self.queue.put((_STOP, None))
+            self.thread.join()
+        if self.loaders is not None:
+            self.loaders.shutdown()
+        self.run_callbacks()
+        self._raise()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()